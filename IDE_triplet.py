@@ -14,6 +14,7 @@ from reid import models
 from reid.utils.my_utils import *
 from reid.trainers import Trainer
 from reid.evaluators import Evaluator
+from reid.feature_extraction.codec import CODECS
 from reid.utils.logging import Logger
 from reid.utils.serialization import save_checkpoint
 
@@ -40,7 +41,9 @@ def main(args):
     dataset, num_classes, train_loader, query_loader, gallery_loader, _ = \
         get_data(args.dataset, args.data_dir, args.height, args.width, args.batch_size, args.num_workers,
                  args.combine_trainval, args.crop, args.tracking_icams, args.tracking_fps, args.re, args.num_instances,
-                 False)
+                 False, eval_cache=args.eval_cache,
+                 packed=args.packed, image_cache=args.image_cache,
+                 batch_augment=args.batch_augment)
 
     # Create model for triplet (num_classes = 0, num_instances > 0)
     model = models.create('ide', num_features=args.features, norm=args.norm,
@@ -58,10 +61,15 @@ def main(args):
     model = nn.DataParallel(model).cuda()
 
     # Evaluator
-    evaluator = Evaluator(model)
+    evaluator = Evaluator(model, flip=args.flip_tta, query_block=args.eval_block,
+                          dtype=getattr(torch, args.eval_dtype), num_workers=args.eval_workers,
+                          rerank=dict(k1=args.k1, k2=args.k2, lambda_value=args.lambda_value)
+                          if args.rerank else None,
+                          qe=dict(k=args.qe_k, alpha=args.qe_alpha, dba=args.dba) if args.qe_k else None)
     if args.evaluate:
         print("Test:")
-        evaluator.evaluate(query_loader, gallery_loader, dataset.query, dataset.gallery, eval_only=True)
+        evaluator.evaluate(query_loader, gallery_loader, dataset.query, dataset.gallery, eval_only=True,
+                           codecs=CODECS if args.codec_report else None)
         return
 
     # Criterion
@@ -93,6 +101,8 @@ def main(args):
             adjust_lr(epoch)
             # train_loss, train_prec = 0, 0
             train_loss, train_prec = trainer.train(epoch, train_loader, optimizer, fix_bn=args.fix_bn)
+            if getattr(train_loader.dataset, 'cache', None) is not None:
+                print(train_loader.dataset.cache.summary())
 
             if epoch < args.start_save:
                 continue
@@ -158,6 +168,34 @@ if __name__ == '__main__':
     parser.add_argument('--fix_bn', type=bool, default=0, help="fix (skip training) BN in base network")
     parser.add_argument('--resume', type=str, default='', metavar='PATH')
     parser.add_argument('--evaluate', action='store_true', help="evaluation only")
+    parser.add_argument('--flip_tta', type=str, default='none', choices=['none', 'avg', 'concat'],
+                        help="evaluate on original and flipped images, averaged or concatenated")
+    parser.add_argument('--codec_report', action='store_true',
+                        help="with --evaluate, report the error and mAP change of the feature storage codecs")
+    parser.add_argument('--eval_block', type=int, default=0,
+                        help="queries per evaluation block, 0 computes the full distance matrix")
+    parser.add_argument('--eval_dtype', type=str, default='float32', choices=['float32', 'float16', 'bfloat16'],
+                        help="precision of the blocked distance computation")
+    parser.add_argument('--eval_workers', type=int, default=0,
+                        help="processes ranking the queries of the full distance matrix, 0 for a single one")
+    parser.add_argument('--rerank', action='store_true', help="evaluate with k-reciprocal re-ranking")
+    parser.add_argument('--k1', type=int, default=20, help="re-ranking k1")
+    parser.add_argument('--k2', type=int, default=6, help="re-ranking k2")
+    parser.add_argument('--lambda_value', type=float, default=0.3, help="re-ranking weight of the original distance")
+    parser.add_argument('--qe_k', type=int, default=0,
+                        help="neighbours of alpha query expansion in evaluation, 0 disables it")
+    parser.add_argument('--qe_alpha', type=float, default=3., help="query expansion weight exponent")
+    parser.add_argument('--dba', action='store_true', help="database-side augmentation before query expansion")
+    parser.add_argument('--batch_augment', action='store_true',
+                        help="flip, pad-crop, normalize and erase whole training batches in collate")
+    parser.add_argument('--image_cache', type=float, default=0, metavar='GB',
+                        help="keep up to this many GB of decoded training images in shared memory for the "
+                             "workers of later epochs, 0 disables it")
+    parser.add_argument('--packed', type=str, default='', metavar='PATH',
+                        help="read the crops from reid/prepare/pack_dataset.py files instead of the JPEGs")
+    parser.add_argument('--eval_cache', type=str, default='', metavar='PATH',
+                        help="keep the decoded test images for later evaluations: 'ram' or a folder for "
+                             "memory-mapped files, default: decode at every evaluation")
     parser.add_argument('--epochs', type=int, default=300)
     parser.add_argument('--step-size', type=int, default=150)
     parser.add_argument('--start_save', type=int, default=0, help="start saving checkpoints after specific epoch")
@@ -2,15 +2,15 @@ from __future__ import print_function, absolute_import
 import os.path as osp
 import numpy as np
 import pdb
-from glob import glob
 import re
-from collections import defaultdict
-import xml.dom.minidom as XD
+
+from .file_index import list_images, read_labels
 
 
 class AI_City(object):
 
     def __init__(self, root, type='reid', fps=10, trainval=False, gt_type='gt'):
+        self.query_list = self.gallery_list = None
         if type == 'tracking_gt':
             if not trainval:
                 train_dir = '~/Data/AIC19/ALL_{}_bbox/train'.format(gt_type)
@@ -33,16 +33,16 @@ class AI_City(object):
             self.query_path = osp.expanduser(query_dir)
 
             xml_dir = osp.join(root, 'train_label.xml')
-            self.reid_info = XD.parse(xml_dir).documentElement.getElementsByTagName('Item')
-            self.index_by_fname_dict = defaultdict()
-            for index in range(len(self.reid_info)):
-                fname = self.reid_info[index].getAttribute('imageName')
-                self.index_by_fname_dict[fname] = index
+            names, vehicle_ids, camera_ids = read_labels(xml_dir)
+            self.reid_info = dict(zip(names, zip(vehicle_ids.tolist(), camera_ids.tolist())))
         else:  # reid_test
             self.train_path = None
             root = osp.expanduser('~/Data/AIC19-reid')
             self.gallery_path = osp.join(root, 'image_test')
             self.query_path = osp.join(root, 'image_query')
+            # the official image lists name_*.txt, the folders are listed when they are missing
+            self.gallery_list = osp.join(root, 'name_test.txt')
+            self.query_list = osp.join(root, 'name_query.txt')
 
         self.train, self.query, self.gallery = [], [], []
         self.num_train_ids, self.num_query_ids, self.num_gallery_ids = 0, 0, 0
@@ -50,31 +50,37 @@ class AI_City(object):
         self.type = type
         self.load()
 
-    def preprocess(self, path, relabel=True, type='reid'):
+    def preprocess(self, path, relabel=True, type='reid', list_fpath=None):
         if type == 'tracking_det':
             pattern = re.compile(r'c([-\d]+)_f(\d+)')
         elif type == 'tracking_gt':
-            pattern = re.compile(r'([-\d]+)_c(\d+)')
+            pattern = re.compile(r'([-\d]+)_c(\d+)(?:_f(\d+))?')
         else:  # reid
             pattern = None
         all_pids = {}
         ret = []
+        # (pid, cam, frame) as in the file name, before relabeling
+        info = []
         if path is None:
-            return ret, int(len(all_pids))
-        fpaths = sorted(glob(osp.join(path, '*.jpg')))
-        for fpath in fpaths:
-            fname = osp.basename(fpath)
+            return ret, int(len(all_pids)), np.zeros([0, 3], dtype=np.int64)
+        if list_fpath is not None and osp.isfile(list_fpath):
+            fnames = read_labels(list_fpath)[0]
+            values = np.zeros([len(fnames), 0], dtype=np.int64)
+        else:
+            fnames, values = list_images(path, pattern)
+        for fname, value in zip(fnames, values.tolist()):
+            frame = -1
             if type == 'tracking_det':
-                cam, frame = map(int, pattern.search(fname).groups())
+                cam, frame = value
                 pid = 1
             elif type == 'tracking_gt':
-                pid, cam = map(int, pattern.search(fname).groups())
+                pid, cam, frame = value
             elif type == 'reid':  # reid
-                pid, cam = map(int, [self.reid_info[self.index_by_fname_dict[fname]].getAttribute('vehicleID'),
-                                     self.reid_info[self.index_by_fname_dict[fname]].getAttribute('cameraID')[1:]])
+                pid, cam = self.reid_info[fname]
             else:  # reid test
                 pid, cam = 1, 1
             if pid == -1: continue
+            info.append((pid, cam, frame))
             if relabel:
                 if pid not in all_pids:
                     all_pids[pid] = len(all_pids)
@@ -84,14 +90,16 @@ class AI_City(object):
             pid = all_pids[pid]
             cam -= 1
             ret.append((fname, pid, cam))
-        return ret, int(len(all_pids))
+        return ret, int(len(all_pids)), np.array(info, dtype=np.int64).reshape(-1, 3)
 
     def load(self):
-        self.train, self.num_train_ids = self.preprocess(self.train_path, True, self.type)
-        self.gallery, self.num_gallery_ids = self.preprocess(self.gallery_path, False,
-                                                             'reid_test' if self.type == 'reid_test' else 'tracking_gt')
-        self.query, self.num_query_ids = self.preprocess(self.query_path, False,
-                                                         'reid_test' if self.type == 'reid_test' else 'tracking_gt')
+        self.train, self.num_train_ids, self.train_info = self.preprocess(self.train_path, True, self.type)
+        self.gallery, self.num_gallery_ids, self.gallery_info = self.preprocess(
+            self.gallery_path, False, 'reid_test' if self.type == 'reid_test' else 'tracking_gt',
+            self.gallery_list)
+        self.query, self.num_query_ids, self.query_info = self.preprocess(
+            self.query_path, False, 'reid_test' if self.type == 'reid_test' else 'tracking_gt',
+            self.query_list)
 
         print(self.__class__.__name__, "dataset loaded")
         print("  subset   | # ids | # images")
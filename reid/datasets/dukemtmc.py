@@ -2,9 +2,10 @@ from __future__ import print_function, absolute_import
 import os.path as osp
 import numpy as np
 import pdb
-from glob import glob
 import re
 
+from .file_index import list_images
+
 
 class DukeMTMC(object):
 
@@ -38,27 +39,32 @@ class DukeMTMC(object):
         if type == 'tracking_det':
             pattern = re.compile(r'c(\d+)_f(\d+)')
         else:
-            pattern = re.compile(r'([-\d]+)_c(\d+)')
+            pattern = re.compile(r'([-\d]+)_c(\d+)(?:_f(\d+))?')
         all_pids = {}
         ret = []
+        # (pid, cam, frame) as in the file name, before relabeling
+        info = []
         if path is None:
-            return ret, int(len(all_pids))
+            return ret, int(len(all_pids)), np.zeros([0, 3], dtype=np.int64)
         if type == 'tracking_gt':
-            fpaths = []
+            fnames, values = [], []
             for iCam in self.iCams:
-                fpaths += sorted(glob(osp.join(path, 'camera' + str(iCam), '*.jpg')))
+                cam_fnames, cam_values = list_images(osp.join(path, 'camera' + str(iCam)), pattern)
+                fnames += cam_fnames
+                values.append(cam_values)
+            values = np.concatenate(values) if values else np.zeros([0, pattern.groups], dtype=np.int64)
         else:
-            fpaths = sorted(glob(osp.join(path, '*.jpg')))
-        for fpath in fpaths:
-            fname = osp.basename(fpath)
+            fnames, values = list_images(path, pattern)
+        for fname, value in zip(fnames, values.tolist()):
             if type == 'tracking_det':
-                cam, frame = map(int, pattern.search(fname).groups())
+                cam, frame = value
                 pid = 8000
             else:
-                pid, cam = map(int, pattern.search(fname).groups())
+                pid, cam, frame = value
             if type == 'tracking_gt':
-                fname = osp.join('camera' + str(cam), osp.basename(fpath))
+                fname = osp.join('camera' + str(cam), fname)
             if pid == -1: continue
+            info.append((pid, cam, frame))
             if relabel:
                 if pid not in all_pids:
                     all_pids[pid] = len(all_pids)
@@ -68,13 +74,13 @@ class DukeMTMC(object):
             pid = all_pids[pid]
             cam -= 1
             ret.append((fname, pid, cam))
-        return ret, int(len(all_pids))
+        return ret, int(len(all_pids)), np.array(info, dtype=np.int64).reshape(-1, 3)
 
     def load(self):
-        self.train, self.num_train_ids = self.preprocess(self.train_path, True, self.type)
-        self.gallery, self.num_gallery_ids = self.preprocess(self.gallery_path, False, self.type)
-        self.query, self.num_query_ids = self.preprocess(self.query_path, False, self.type)
-        self.camstyle, self.num_camstyle_ids = self.preprocess(self.camstyle_path, True, self.type)
+        self.train, self.num_train_ids, self.train_info = self.preprocess(self.train_path, True, self.type)
+        self.gallery, self.num_gallery_ids, self.gallery_info = self.preprocess(self.gallery_path, False, self.type)
+        self.query, self.num_query_ids, self.query_info = self.preprocess(self.query_path, False, self.type)
+        self.camstyle, self.num_camstyle_ids, _ = self.preprocess(self.camstyle_path, True, self.type)
 
         print(self.__class__.__name__, "dataset loaded")
         print("  subset   | # ids | # images")
@@ -0,0 +1,148 @@
+from __future__ import absolute_import
+import hashlib
+import io
+import os
+import os.path as osp
+import re
+from xml.etree import ElementTree
+
+import numpy as np
+
+from ..utils.osutils import mkdir_if_missing
+
+CACHE_DIR = osp.join(osp.expanduser('~'), '.cache', 'reid', 'file_index')
+
+
+def _listdir(path, ext):
+    # as glob('*' + ext): hidden files are skipped
+    return [fname for fname in os.listdir(path) if fname.endswith(ext) and not fname.startswith('.')]
+
+
+def _scan(path, pattern, ext):
+    fnames = sorted(_listdir(path, ext))
+    if pattern is None:
+        return fnames, np.zeros([len(fnames), 0], dtype=np.int64)
+    values = np.empty([len(fnames), pattern.groups], dtype=np.int64)
+    for i, fname in enumerate(fnames):
+        match = pattern.search(fname)
+        if match is None:
+            raise ValueError("{} does not match {}".format(osp.join(path, fname), pattern.pattern))
+        values[i] = [int(value) for value in match.groups(-1)]
+    return fnames, values
+
+
+def list_images(path, pattern=None, ext='.jpg', check_count=True, cache_dir=CACHE_DIR):
+    """Sorted names of the ``*<ext>`` files of ``path`` and the integer groups
+    that ``pattern`` finds in them, ``[N, groups]`` with -1 for an optional
+    group that did not match.
+
+    The result is cached in ``cache_dir`` as a binary index per directory and
+    pattern, valid as long as the modification time of the directory, which
+    changes with every file added, removed or renamed, and the number of
+    files are the same. The count catches the changes a coarse mtime (NFS)
+    misses, at the cost of a directory listing, still far below the scan;
+    ``check_count=False`` trusts the mtime alone.
+    """
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    if not osp.isdir(path):
+        # e.g. a dataset without camstyle images
+        return [], np.zeros([0, pattern.groups if pattern is not None else 0], dtype=np.int64)
+    path = osp.abspath(path)
+    mtime = os.stat(path).st_mtime_ns
+    key = '\n'.join([path, pattern.pattern if pattern is not None else '', ext])
+    fpath = osp.join(cache_dir, hashlib.md5(key.encode()).hexdigest() + '.npz')
+    if osp.isfile(fpath):
+        try:
+            index = np.load(fpath)
+            valid = int(index['mtime']) == mtime and str(index['key']) == key
+            if valid and check_count:
+                valid = int(index['count']) == len(_listdir(path, ext))
+            if valid:
+                return np.char.decode(index['fnames'], 'utf-8').tolist(), index['values']
+        except (IOError, OSError, ValueError, KeyError):
+            # unreadable or from an older layout, scanned again
+            pass
+
+    fnames, values = _scan(path, pattern, ext)
+    try:
+        mkdir_if_missing(cache_dir)
+        # written under a temporary name, readers never see a partial index
+        tmp_fpath = '{}.{}.tmp.npz'.format(fpath[:-len('.npz')], os.getpid())
+        np.savez(tmp_fpath, fnames=np.array([fname.encode('utf-8') for fname in fnames], dtype=bytes).reshape(-1),
+                 values=values, mtime=mtime, count=len(fnames), key=key)
+        os.replace(tmp_fpath, fpath)
+    except (IOError, OSError):
+        # a read-only home only loses the cache
+        pass
+    return fnames, values
+
+
+def _iter_elements(fpath, chunk_size=1 << 20):
+    # expat reads no multi-byte encodings such as the gb2312 the AIC19 label
+    # files declare, the text is decoded here and fed without the declaration
+    with open(fpath, 'rb') as f:
+        head = f.read(256)
+    match = re.match(br'\s*<\?xml[^>]*?encoding=["\']([-\w]+)["\'][^>]*\?>', head)
+    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    parser = ElementTree.XMLPullParser(events=('end',))
+    with io.open(fpath, encoding=encoding) as f:
+        data = f.read(chunk_size)
+        data = re.sub(r'^\s*<\?xml[^>]*\?>', '', data, count=1)
+        while data:
+            parser.feed(data)
+            for _, elem in parser.read_events():
+                yield elem
+            data = f.read(chunk_size)
+    parser.close()
+    for _, elem in parser.read_events():
+        yield elem
+
+
+def _parse_labels(fpath):
+    names, vehicle_ids, camera_ids = [], [], []
+    if fpath.endswith('.txt'):
+        # name_query.txt / name_test.txt: one image name per line, no labels
+        with open(fpath) as f:
+            names = [line.strip() for line in f if line.strip()]
+        vehicle_ids = camera_ids = [-1] * len(names)
+    else:
+        # train_label.xml / test_label.xml: <Item imageName= vehicleID= cameraID= .../>
+        for elem in _iter_elements(fpath):
+            if elem.tag == 'Item':
+                names.append(elem.get('imageName'))
+                vehicle_ids.append(int(elem.get('vehicleID')))
+                camera_ids.append(int(elem.get('cameraID').lstrip('c')))
+            # the parsed items are dropped as the file is read, memory stays bounded
+            elem.clear()
+    return names, np.array(vehicle_ids, dtype=np.int64), np.array(camera_ids, dtype=np.int64)
+
+
+def read_labels(fpath):
+    """Image names, vehicle ids and camera ids (``'c001'`` is 1) of an AIC19 /
+    VeRi label file, the ``train_label.xml`` style XML or the ``name_*.txt``
+    lists of the test and query sets (ids are -1 there).
+
+    The file is parsed in one streaming pass, the arrays are kept in
+    ``fpath + '.npz'`` and reused while the size and modification time of
+    the label file are the same.
+    """
+    stat = os.stat(fpath)
+    cache_fpath = fpath + '.npz'
+    if osp.isfile(cache_fpath):
+        try:
+            index = np.load(cache_fpath)
+            if int(index['mtime']) == stat.st_mtime_ns and int(index['size']) == stat.st_size:
+                return np.char.decode(index['names'], 'utf-8').tolist(), index['vehicle_ids'], index['camera_ids']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    names, vehicle_ids, camera_ids = _parse_labels(fpath)
+    try:
+        tmp_fpath = '{}.{}.tmp.npz'.format(fpath, os.getpid())
+        np.savez(tmp_fpath, names=np.array([name.encode('utf-8') for name in names], dtype=bytes).reshape(-1),
+                 vehicle_ids=vehicle_ids, camera_ids=camera_ids, mtime=stat.st_mtime_ns, size=stat.st_size)
+        os.replace(tmp_fpath, cache_fpath)
+    except (IOError, OSError):
+        pass
+    return names, vehicle_ids, camera_ids
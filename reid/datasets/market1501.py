@@ -2,9 +2,10 @@ from __future__ import print_function, absolute_import
 import os.path as osp
 import numpy as np
 import pdb
-from glob import glob
 import re
 
+from .file_index import list_images
+
 
 class Market1501(object):
 
@@ -23,10 +24,8 @@ class Market1501(object):
         pattern = re.compile(r'([-\d]+)_c(\d+)')
         all_pids = {}
         ret = []
-        fpaths = sorted(glob(osp.join(path, '*.jpg')))
-        for fpath in fpaths:
-            fname = osp.basename(fpath)
-            pid, cam = map(int, pattern.search(fname).groups())
+        fnames, values = list_images(path, pattern)
+        for fname, (pid, cam) in zip(fnames, values.tolist()):
             if pid == -1: continue
             if relabel:
                 if pid not in all_pids:
@@ -1,7 +1,8 @@
 from __future__ import print_function, absolute_import
 import os.path as osp
 import re
-from glob import glob
+
+from .file_index import list_images
 
 
 class VeRi(object):
@@ -22,10 +23,8 @@ class VeRi(object):
         pattern = re.compile(r'(\d+)_c(\d+)')
         all_pids = {}
         ret = []
-        fpaths = sorted(glob(osp.join(path, '*.jpg')))
-        for fpath in fpaths:
-            fname = osp.basename(fpath)
-            pid, cam = map(int, pattern.search(fname).groups())
+        fnames, values = list_images(path, pattern)
+        for fname, (pid, cam) in zip(fnames, values.tolist()):
             if pid == -1: continue
             if pid not in all_pids:
                 all_pids[pid] = len(all_pids)
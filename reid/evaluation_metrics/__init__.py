@@ -1,10 +1,19 @@
 from __future__ import absolute_import
 
 from .classification import accuracy
-from .ranking import cmc, mean_ap
+from .ranking import cmc, mean_ap, topk
+from .streaming import streaming_evaluate
+from .parallel import parallel_evaluate
+from .rerank import k_reciprocal_rerank
+from .query_expansion import query_expansion
 
 __all__ = [
     'accuracy',
     'cmc',
     'mean_ap',
+    'topk',
+    'streaming_evaluate',
+    'parallel_evaluate',
+    'k_reciprocal_rerank',
+    'query_expansion',
 ]
@@ -0,0 +1,191 @@
+from __future__ import print_function, absolute_import
+import argparse
+import gc
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+import traceback
+import tracemalloc
+from queue import Empty
+
+import numpy as np
+import torch
+
+STAGES = ['pairwise_distance', 'mean_ap', 'cmc', 'evaluate_all', 'streaming_evaluate', 'parallel_evaluate']
+
+
+def synthetic_data(num_query, num_gallery, num_ids=500, num_cams=8, dim=256, noise=1., seed=0):
+    """Features drawn around one random center per id, with random ids and
+    cameras. Returns ``(query_features, gallery_features, query_ids,
+    gallery_ids, query_cams, gallery_cams)``, float32 tensors and int64 arrays."""
+    rng = np.random.RandomState(seed)
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(num_ids, dim, generator=generator)
+    query_ids, gallery_ids = rng.randint(num_ids, size=num_query), rng.randint(num_ids, size=num_gallery)
+    query_cams, gallery_cams = rng.randint(num_cams, size=num_query), rng.randint(num_cams, size=num_gallery)
+    query_features = centers[torch.from_numpy(query_ids)] + noise * torch.randn(num_query, dim, generator=generator)
+    gallery_features = centers[torch.from_numpy(gallery_ids)] + \
+                       noise * torch.randn(num_gallery, dim, generator=generator)
+    return query_features, gallery_features, query_ids, gallery_ids, query_cams, gallery_cams
+
+
+def _proc_status(field):
+    # VmRSS / VmHWM in bytes, None without /proc
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    """Returns the current rss, with the peak (VmHWM) reset to it on linux,
+    else the max rss so far, which hides peaks below an earlier one."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return _proc_status('VmRSS')
+    except (IOError, OSError):
+        return _peak_rss()
+
+
+def _peak_rss():
+    peak = _proc_status('VmHWM')
+    if peak is not None:
+        return peak
+    # bytes on macOS, kilobytes on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def run_stage(stage, num_query, num_gallery, num_ids=500, num_cams=8, dim=256, seed=0, num_workers=0):
+    """Times one evaluation stage on synthetic data, the inputs (features or
+    distance matrix) are built before the clock starts.
+
+    Returns ``{'seconds', 'peak_traced', 'peak_rss'}``: the peak of the numpy
+    allocations seen by tracemalloc, and the peak rss of the process during
+    the stage above its rss at the start, which also covers torch. Both are bytes.
+    """
+    from ..evaluators import pairwise_distance, evaluate_all
+    from . import cmc, mean_ap, streaming_evaluate, parallel_evaluate
+
+    query_features, gallery_features, query_ids, gallery_ids, query_cams, gallery_cams = \
+        synthetic_data(num_query, num_gallery, num_ids, num_cams, dim, seed=seed)
+    labels = (query_ids, gallery_ids, query_cams, gallery_cams)
+    if stage in ('pairwise_distance', 'streaming_evaluate'):
+        inputs = (query_features, gallery_features)
+    else:
+        inputs = (pairwise_distance(query_features, gallery_features).numpy(),)
+        del query_features, gallery_features
+    funcs = {
+        'pairwise_distance': lambda x, y: pairwise_distance(x, y),
+        'mean_ap': lambda distmat: mean_ap(distmat, *labels),
+        'cmc': lambda distmat: cmc(distmat, *labels, separate_camera_set=False, single_gallery_shot=False,
+                                   first_match_break=True),
+        'evaluate_all': lambda distmat: evaluate_all(distmat, None, None, *labels),
+        'streaming_evaluate': lambda x, y: streaming_evaluate(x, y, *labels),
+        'parallel_evaluate': lambda distmat: parallel_evaluate(distmat, *labels, num_workers=num_workers),
+    }
+    gc.collect()
+    rss = _reset_peak_rss()
+    tracemalloc.start()
+    tic = time.time()
+    funcs[stage](*inputs)
+    seconds = time.time() - tic
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': seconds, 'peak_traced': peak_traced, 'peak_rss': max(_peak_rss() - rss, 0)}
+
+
+def _run_stage(kwargs, queue):
+    # not a pool worker: parallel_evaluate starts processes of its own
+    try:
+        queue.put((True, run_stage(**kwargs)))
+    except Exception:
+        queue.put((False, traceback.format_exc()))
+
+
+def _get_result(stage, process, queue, poll=1.):
+    # a child killed by the OOM killer or a signal never puts its result
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if not process.is_alive():
+                # the result may have arrived just before the exit
+                try:
+                    return queue.get(timeout=poll)
+                except Empty:
+                    raise RuntimeError('{} died without a result, exit code {}'.format(stage, process.exitcode))
+
+
+def benchmark(sizes, stages=STAGES[:4], num_ids=500, num_cams=8, dim=256, repeat=1, seed=0, num_workers=0,
+              isolate=True):
+    """Runs every stage at every ``(num_query, num_gallery)`` size.
+
+    With ``isolate``, each run happens in a fresh process, so the memory
+    left over by earlier runs does not count. Returns one record per run.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for num_query, num_gallery in sizes:
+        for stage in stages:
+            for run in range(repeat):
+                kwargs = dict(stage=stage, num_query=num_query, num_gallery=num_gallery, num_ids=num_ids,
+                              num_cams=num_cams, dim=dim, seed=seed + run, num_workers=num_workers)
+                if isolate:
+                    queue = ctx.Queue()
+                    process = ctx.Process(target=_run_stage, args=(kwargs, queue))
+                    process.start()
+                    ok, result = _get_result(stage, process, queue)
+                    process.join()
+                    if not ok:
+                        raise RuntimeError('{} failed:\n{}'.format(stage, result))
+                else:
+                    result = run_stage(**kwargs)
+                record = dict(stage=stage, num_query=num_query, num_gallery=num_gallery, num_ids=num_ids,
+                              num_cams=num_cams, dim=dim, run=run, **result)
+                results.append(record)
+                print('{:>18} {:7d} x {:7d}: {:8.3f}s, peak traced {:8.1f} MB, peak rss +{:8.1f} MB'
+                      .format(stage, num_query, num_gallery, result['seconds'], result['peak_traced'] / 2 ** 20,
+                              result['peak_rss'] / 2 ** 20))
+    return results
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'numpy': np.__version__,
+            'torch': torch.__version__, 'num_threads': torch.get_num_threads()}
+
+
+def main(args):
+    sizes = [(num_query, num_gallery) for num_gallery in args.num_gallery for num_query in args.num_query]
+    results = benchmark(sizes, args.stages, args.num_ids, args.num_cams, args.dim, args.repeat, args.seed,
+                        args.num_workers, not args.no_isolate)
+    report = {'config': vars(args), 'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=1)
+        print('wrote {}'.format(args.output))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-ID evaluation benchmark on synthetic data")
+    parser.add_argument('--num_query', type=int, nargs='+', default=[1000])
+    parser.add_argument('--num_gallery', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--num_ids', type=int, default=500)
+    parser.add_argument('--num_cams', type=int, default=8)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--stages', type=str, nargs='+', default=STAGES[:4], choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_workers', type=int, default=0, help="processes of parallel_evaluate")
+    parser.add_argument('--no_isolate', action='store_true', help="run all stages in this process")
+    parser.add_argument('--output', type=str, default='', help="json file of the results")
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+from __future__ import absolute_import
+import multiprocessing
+import os
+import os.path as osp
+import tempfile
+
+import numpy as np
+
+from .ranking import _prepare, _cmc_histogram, _average_precisions
+
+# per worker process: the memory-mapped distance matrix and the ids / cams
+_shared = {}
+
+
+def _init_worker(fpath, shape, dtype, query_ids, gallery_ids, query_cams, gallery_cams):
+    _shared['distmat'] = np.memmap(fpath, dtype=dtype, mode='r', shape=shape)
+    _shared['labels'] = (query_ids, gallery_ids, query_cams, gallery_cams)
+
+
+def _evaluate_shard(task):
+    start, stop, topk, first_match_break = task
+    query_ids, gallery_ids, query_cams, gallery_cams = _shared['labels']
+    distmat = np.asarray(_shared['distmat'][start:stop])
+    aps = _average_precisions(distmat, query_ids[start:stop], gallery_ids, query_cams[start:stop], gallery_cams)
+    ret, num_valid_queries = _cmc_histogram(distmat, query_ids[start:stop], gallery_ids, query_cams[start:stop],
+                                            gallery_cams, topk, first_match_break=first_match_break)
+    return start, aps, ret, num_valid_queries
+
+
+def _num_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def parallel_evaluate(distmat, query_ids=None, gallery_ids=None, query_cams=None, gallery_cams=None,
+                      topk=100, first_match_break=True, num_workers=0, shard_size=0):
+    """mAP and CMC with the queries split across a process pool.
+
+    The distance matrix is shared through a memory-mapped file (in /dev/shm
+    when available, an ``np.memmap`` input is used in place), workers read
+    their query rows from it. Per-shard AP lists and CMC histograms are
+    merged in query order, the results equal ``mean_ap`` and ``cmc``.
+
+    Returns:
+        (mAP, cmc_scores)
+    """
+    distmat, query_ids, gallery_ids, query_cams, gallery_cams = _prepare(
+        distmat, query_ids, gallery_ids, query_cams, gallery_cams)
+    m = distmat.shape[0]
+    num_workers = num_workers or _num_cores()
+    # a few shards per worker balance the load
+    shard_size = shard_size or max(1, int(np.ceil(m / float(4 * num_workers))))
+
+    tmp_fpath = None
+    if isinstance(distmat, np.memmap) and distmat.filename and distmat.offset == 0 and \
+            distmat.flags['C_CONTIGUOUS'] and distmat.shape[0] == m:
+        fpath = distmat.filename
+    else:
+        fd, tmp_fpath = tempfile.mkstemp(suffix='.distmat', dir='/dev/shm' if osp.isdir('/dev/shm') else None)
+        os.close(fd)
+        shared = np.memmap(tmp_fpath, dtype=distmat.dtype, mode='w+', shape=distmat.shape)
+        shared[:] = distmat
+        shared.flush()
+        del shared
+        fpath = tmp_fpath
+    try:
+        tasks = [(start, min(start + shard_size, m), topk, first_match_break) for start in range(0, m, shard_size)]
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                    initargs=(fpath, distmat.shape, distmat.dtype,
+                                              query_ids, gallery_ids, query_cams, gallery_cams))
+        try:
+            results = sorted(pool.imap_unordered(_evaluate_shard, tasks), key=lambda result: result[0])
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        if tmp_fpath is not None:
+            os.remove(tmp_fpath)
+
+    aps = np.concatenate([aps for _, aps, _, _ in results])
+    ret = sum(ret for _, _, ret, _ in results)
+    num_valid_queries = sum(num_valid for _, _, _, num_valid in results)
+    if num_valid_queries == 0:
+        raise RuntimeError("No valid query")
+    return np.mean(aps), ret.cumsum() / num_valid_queries
@@ -0,0 +1,51 @@
+from __future__ import absolute_import
+
+import torch
+import torch.nn.functional as F
+
+from ..utils import to_torch
+
+
+def _block_size(n, k, dim):
+    # about 16M elements of similarities or gathered neighbours per block
+    return max(1, 2 ** 24 // max(n, k * dim, 1))
+
+
+def _expand(x, database, k, alpha, include_self):
+    """Every row of ``x`` becomes the normalized sum of its ``k`` nearest
+    (cosine) database rows weighted by ``similarity ** alpha``, plus itself
+    with weight 1 when ``include_self``. One matrix product finds the
+    neighbours of a block of rows, a gather and a batched product sum them."""
+    k = min(k, len(database))
+    out = torch.empty_like(x)
+    block_size = _block_size(len(database), k, x.size(1))
+    for start in range(0, len(x), block_size):
+        block = x[start:start + block_size]
+        sims, index = block.mm(database.t()).topk(k, 1)
+        weights = sims.clamp(min=0) ** alpha
+        expanded = torch.bmm(weights.unsqueeze(1), database[index]).squeeze(1)
+        out[start:start + block_size] = expanded + block if include_self else expanded
+    return F.normalize(out, dim=1)
+
+
+def query_expansion(query_features, gallery_features, k=10, alpha=3., dba=False):
+    """alpha query expansion (alpha-QE), optionally after database-side
+    augmentation (DBA) of the gallery.
+
+    Features are l2-normalized. With ``dba``, every gallery feature is
+    replaced by the weighted sum of its ``k + 1`` nearest gallery features
+    (itself included). Every query is then replaced by itself plus its ``k``
+    nearest gallery features, weighted by ``cosine ** alpha`` (``alpha=0``
+    is average QE). Both steps cost one blocked matrix product over the
+    gallery, there is no loop over the queries.
+
+    Returns:
+        (query_features, gallery_features), l2-normalized float tensors.
+    """
+    x = F.normalize(to_torch(query_features).float().view(len(query_features), -1), dim=1)
+    y = F.normalize(to_torch(gallery_features).float().view(len(gallery_features), -1), dim=1)
+    if k <= 0:
+        return x, y
+    if dba:
+        y = _expand(y, y, k + 1, alpha, include_self=False)
+    return _expand(x, y, k, alpha, include_self=True), y
@@ -2,24 +2,44 @@ from __future__ import absolute_import
 from collections import defaultdict
 
 import numpy as np
-from sklearn.metrics import average_precision_score
 
 from ..utils import to_numpy
 
 
 def _unique_sample(ids_dict, num):
-    mask = np.zeros(num, dtype=np.bool)
+    mask = np.zeros(num, dtype=bool)
     for _, indices in ids_dict.items():
         i = np.random.choice(indices)
         mask[i] = True
     return mask
 
 
-def cmc(distmat, query_ids=None, gallery_ids=None,
-        query_cams=None, gallery_cams=None, topk=100,
-        separate_camera_set=False,
-        single_gallery_shot=False,
-        first_match_break=False):
+def topk(distmat, k, largest=False):
+    """Indices of the ``k`` smallest (or largest) entries of every row, in order.
+
+    Same as ``np.argsort(distmat, axis=1, kind='stable')[:, :k]``, but only
+    the selected entries are sorted after an ``np.argpartition``.
+    """
+    distmat = to_numpy(distmat)
+    if largest:
+        distmat = -distmat
+    n = distmat.shape[1]
+    if k >= n:
+        return np.argsort(distmat, axis=1, kind='stable')[:, :k]
+    index = np.argpartition(distmat, k - 1, axis=1)[:, :k]
+    # sort the selection by distance, ties by index
+    index.sort(axis=1)
+    order = np.argsort(np.take_along_axis(distmat, index, axis=1), axis=1, kind='stable')
+    index = np.take_along_axis(index, order, axis=1)
+    # rows with ties across the k-th entry pick the lowest indices, as a full sort
+    kth = np.take_along_axis(distmat, index[:, -1:], axis=1)
+    tied = (distmat <= kth).sum(axis=1) > k
+    if tied.any():
+        index[tied] = np.argsort(distmat[tied], axis=1, kind='stable')[:, :k]
+    return index
+
+
+def _prepare(distmat, query_ids=None, gallery_ids=None, query_cams=None, gallery_cams=None):
     distmat = to_numpy(distmat)
     m, n = distmat.shape
     # Fill up default values
@@ -32,10 +52,35 @@ def cmc(distmat, query_ids=None, gallery_ids=None,
     if gallery_cams is None:
         gallery_cams = np.ones(n).astype(np.int32)
     # Ensure numpy array
-    query_ids = np.asarray(query_ids)
-    gallery_ids = np.asarray(gallery_ids)
-    query_cams = np.asarray(query_cams)
-    gallery_cams = np.asarray(gallery_cams)
+    return (distmat, np.asarray(query_ids), np.asarray(gallery_ids),
+            np.asarray(query_cams), np.asarray(gallery_cams))
+
+
+def _sorted_blocks(distmat, query_ids, gallery_ids, query_cams, gallery_cams, block_size=None, k=None):
+    """Yields ``(start, stop, indices, same_id, same_cam)`` for blocks of
+    queries, sorted by distance. Only a block of rows is held at once.
+
+    With ``k``, only the first ``k(start, stop)`` ranks of a block are sorted.
+    Tied distances are ranked by gallery index either way.
+    """
+    m, n = distmat.shape
+    if block_size is None:
+        # about 16M elements per block
+        block_size = max(1, 2 ** 24 // max(n, 1))
+    for start in range(0, m, block_size):
+        stop = min(start + block_size, m)
+        if k is None:
+            indices = np.argsort(distmat[start:stop], axis=1, kind='stable')
+        else:
+            indices = topk(distmat[start:stop], k(start, stop))
+        same_id = gallery_ids[indices] == query_ids[start:stop, np.newaxis]
+        same_cam = gallery_cams[indices] == query_cams[start:stop, np.newaxis]
+        yield start, stop, indices, same_id, same_cam
+
+
+def _cmc_single_gallery_shot(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk,
+                             separate_camera_set, first_match_break):
+    m, n = distmat.shape
     # Sort and find correct matches
     indices = np.argsort(distmat, axis=1)
     matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
@@ -50,22 +95,16 @@ def cmc(distmat, query_ids=None, gallery_ids=None,
             # Filter out samples from same camera
             valid &= (gallery_cams[indices[i]] != query_cams[i])
         if not np.any(matches[i, valid]): continue
-        if single_gallery_shot:
-            repeat = 10
-            gids = gallery_ids[indices[i][valid]]
-            inds = np.where(valid)[0]
-            ids_dict = defaultdict(list)
-            for j, x in zip(inds, gids):
-                ids_dict[x].append(j)
-        else:
-            repeat = 1
+        repeat = 10
+        gids = gallery_ids[indices[i][valid]]
+        inds = np.where(valid)[0]
+        ids_dict = defaultdict(list)
+        for j, x in zip(inds, gids):
+            ids_dict[x].append(j)
         for _ in range(repeat):
-            if single_gallery_shot:
-                # Randomly choose one instance for each id
-                sampled = (valid & _unique_sample(ids_dict, len(valid)))
-                index = np.nonzero(matches[i, sampled])[0]
-            else:
-                index = np.nonzero(matches[i, valid])[0]
+            # Randomly choose one instance for each id
+            sampled = (valid & _unique_sample(ids_dict, len(valid)))
+            index = np.nonzero(matches[i, sampled])[0]
             delta = 1. / (len(index) * repeat)
             for j, k in enumerate(index):
                 if k - j >= topk: break
@@ -79,37 +118,98 @@ def cmc(distmat, query_ids=None, gallery_ids=None,
     return ret.cumsum() / num_valid_queries
 
 
-def mean_ap(distmat, query_ids=None, gallery_ids=None,
-            query_cams=None, gallery_cams=None):
-    distmat = to_numpy(distmat)
-    m, n = distmat.shape
-    # Fill up default values
-    if query_ids is None:
-        query_ids = np.arange(m)
-    if gallery_ids is None:
-        gallery_ids = np.arange(n)
-    if query_cams is None:
-        query_cams = np.zeros(m).astype(np.int32)
-    if gallery_cams is None:
-        gallery_cams = np.ones(n).astype(np.int32)
-    # Ensure numpy array
-    query_ids = np.asarray(query_ids)
-    gallery_ids = np.asarray(gallery_ids)
-    query_cams = np.asarray(query_cams)
-    gallery_cams = np.asarray(gallery_cams)
-    # Sort and find correct matches
-    indices = np.argsort(distmat, axis=1)
-    matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
-    # Compute AP for each query
-    aps = []
-    for i in range(m):
+def cmc(distmat, query_ids=None, gallery_ids=None,
+        query_cams=None, gallery_cams=None, topk=100,
+        separate_camera_set=False,
+        single_gallery_shot=False,
+        first_match_break=False, block_size=None):
+    distmat, query_ids, gallery_ids, query_cams, gallery_cams = _prepare(
+        distmat, query_ids, gallery_ids, query_cams, gallery_cams)
+    if single_gallery_shot:
+        # random sampling per query, kept as a loop
+        return _cmc_single_gallery_shot(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk,
+                                        separate_camera_set, first_match_break)
+    ret, num_valid_queries = _cmc_histogram(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk,
+                                            separate_camera_set, first_match_break, block_size)
+    if num_valid_queries == 0:
+        raise RuntimeError("No valid query")
+    return ret.cumsum() / num_valid_queries
+
+
+def _cmc_histogram(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk=100,
+                   separate_camera_set=False, first_match_break=False, block_size=None):
+    """CMC before the cumulative sum, and the number of valid queries."""
+    ret = np.zeros(topk)
+    num_valid_queries = 0
+    if separate_camera_set:
+        # any number of same camera samples could precede a match, the whole rows are sorted
+        rank_limit = None
+    else:
+        # a match ranked below topk follows fewer than topk valid non-matches and fewer samples of
+        # its own id, so only that many entries are sorted
+        gallery_id_set, gallery_id_counts = np.unique(gallery_ids, return_counts=True)
+        pos = np.minimum(np.searchsorted(gallery_id_set, query_ids), len(gallery_id_set) - 1)
+        same_id_counts = np.where(gallery_id_set[pos] == query_ids, gallery_id_counts[pos], 0)
+
+        def _rank_limit(start, stop):
+            return topk + int(same_id_counts[start:stop].max())
+        rank_limit = _rank_limit
+    for start, stop, indices, matches, same_cam in _sorted_blocks(
+            distmat, query_ids, gallery_ids, query_cams, gallery_cams, block_size, rank_limit):
+        # true matches of the whole rows, the sorted ranks may be cut
+        all_matches = ((gallery_ids == query_ids[start:stop, np.newaxis]) &
+                       (gallery_cams != query_cams[start:stop, np.newaxis]))
         # Filter out the same id and same camera
-        valid = ((gallery_ids[indices[i]] != query_ids[i]) |
-                 (gallery_cams[indices[i]] != query_cams[i]))
-        y_true = matches[i, valid]
-        y_score = -distmat[i][indices[i]][valid]
-        if not np.any(y_true): continue
-        aps.append(average_precision_score(y_true, y_score))
+        valid = ~matches | ~same_cam
+        if separate_camera_set:
+            # Filter out samples from same camera
+            valid &= ~same_cam
+        matches &= valid
+        has_match = all_matches.any(axis=1)
+        # rank of a match: valid non-matches sorted before it
+        ranks = np.cumsum(valid & ~matches, axis=1)
+        if first_match_break:
+            first = matches.argmax(axis=1)
+            rank = ranks[np.arange(len(ranks)), first][matches.any(axis=1)]
+            ret += np.bincount(rank[rank < topk], minlength=topk)
+        else:
+            rows, cols = np.nonzero(matches)
+            rank = ranks[rows, cols]
+            delta = 1. / all_matches.sum(axis=1)[rows]
+            keep = rank < topk
+            ret += np.bincount(rank[keep], weights=delta[keep], minlength=topk)
+        num_valid_queries += has_match.sum()
+    return ret, int(num_valid_queries)
+
+
+def mean_ap(distmat, query_ids=None, gallery_ids=None,
+            query_cams=None, gallery_cams=None, block_size=None):
+    distmat, query_ids, gallery_ids, query_cams, gallery_cams = _prepare(
+        distmat, query_ids, gallery_ids, query_cams, gallery_cams)
+    aps = _average_precisions(distmat, query_ids, gallery_ids, query_cams, gallery_cams, block_size)
     if len(aps) == 0:
         raise RuntimeError("No valid query")
     return np.mean(aps)
+
+
+def _average_precisions(distmat, query_ids, gallery_ids, query_cams, gallery_cams, block_size=None):
+    """AP of every query with a true match, in query order."""
+    n = distmat.shape[1]
+    aps = []
+    for start, stop, indices, matches, same_cam in _sorted_blocks(
+            distmat, query_ids, gallery_ids, query_cams, gallery_cams, block_size):
+        # Filter out the same id and same camera
+        valid = ~matches | ~same_cam
+        y_true = matches & valid
+        num_pos = y_true.sum(axis=1)
+        # as average_precision_score: tied distances form one threshold, precision is taken at its end
+        dist = np.take_along_axis(distmat[start:stop], indices, axis=1)
+        tie_end = np.full(dist.shape, n - 1)
+        tie_end[:, :-1] = np.where(dist[:, 1:] != dist[:, :-1], np.arange(n - 1), n)
+        tie_end = np.minimum.accumulate(tie_end[:, ::-1], axis=1)[:, ::-1]
+        true_pos = np.take_along_axis(np.cumsum(y_true, axis=1), tie_end, axis=1)
+        num_ranked = np.take_along_axis(np.cumsum(valid, axis=1), tie_end, axis=1)
+        precision = true_pos / np.maximum(num_ranked, 1).astype(np.float64)
+        ap = (precision * y_true).sum(axis=1)
+        aps.append(ap[num_pos > 0] / num_pos[num_pos > 0])
+    return np.concatenate(aps) if aps else np.zeros(0)
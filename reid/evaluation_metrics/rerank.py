@@ -0,0 +1,207 @@
+from __future__ import print_function, absolute_import
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import sparse
+
+from .ranking import topk
+from ..utils import to_numpy
+
+
+def _distance(x, y):
+    # squared euclidean distance, as evaluators.pairwise_distance
+    return (x ** 2).sum(1)[:, np.newaxis] + (y ** 2).sum(1)[np.newaxis, :] - 2 * x.dot(y.T)
+
+
+def _block_size(n, block_size):
+    # about 16M distances per block
+    return block_size or max(1, 2 ** 24 // max(n, 1))
+
+
+def _reciprocal(rank, k, block_size):
+    # mask of the first k + 1 neighbours j of every i that have i in their own first k + 1
+    rank = rank[:, :k + 1]
+    mask = np.empty(rank.shape, dtype=bool)
+    for start in range(0, len(rank), block_size):
+        stop = min(start + block_size, len(rank))
+        mask[start:stop] = (rank[rank[start:stop]] == np.arange(start, stop)[:, np.newaxis, np.newaxis]).any(2)
+    return mask
+
+
+def _expansion(rank, mask, half_rank, half_mask, start, stop):
+    """k-reciprocal sets of rows ``start:stop``, each extended by the half-size
+    sets of its members that overlap it by more than 2/3. Returns a sorted
+    ``[stop - start, L]`` index padded with ``len(rank)``."""
+    n = len(rank)
+    forward = rank[start:stop]
+    recip = np.where(mask[start:stop], forward, n)
+    cand = half_rank[forward]
+    cand_mask = half_mask[forward]
+    # |R(c, k1 / 2) & R(i, k1)| > 2/3 |R(c, k1 / 2)| for every member c of R(i, k1)
+    overlap = ((cand[..., np.newaxis] == recip[:, np.newaxis, np.newaxis, :]).any(3) & cand_mask).sum(2)
+    accept = mask[start:stop] & (overlap > 2. / 3 * cand_mask.sum(2))
+    cand = np.where(accept[..., np.newaxis] & cand_mask, cand, n)
+    index = np.concatenate([recip, cand.reshape(len(forward), -1)], 1)
+    index.sort(axis=1)
+    index[:, 1:][index[:, 1:] == index[:, :-1]] = n
+    index.sort(axis=1)
+    return index[:, :(index < n).sum(1).max()]
+
+
+def k_reciprocal_rerank(query_features, gallery_features, k1=20, k2=6, lambda_value=0.3, block_size=0):
+    """k-reciprocal re-ranking (Zhong et al., CVPR 2017) without the dense
+    ``(m + n) ^ 2`` matrices.
+
+    Distances are computed for blocks of ``block_size`` rows against all
+    ``m + n`` samples and reduced right away to the ``k1 + 1`` nearest
+    neighbours and the row maximum. The k-reciprocal weights ``V`` and their
+    query expansion are sparse, ``(m + n) * k`` entries, and the Jaccard
+    distance only visits the gallery samples that share a neighbour with a
+    query. Two passes of distance blocks are made in total.
+
+    Returns:
+        [m, n] float32 re-ranked distances, ``lambda_value`` weights the
+        original (row-normalized) distance against the Jaccard distance.
+    """
+    x = np.asarray(to_numpy(query_features), dtype=np.float32)
+    y = np.asarray(to_numpy(gallery_features), dtype=np.float32)
+    m, n = len(x), len(y)
+    features = np.concatenate([x.reshape(m, -1), y.reshape(n, -1)])
+    num = m + n
+    block_size = _block_size(num, block_size)
+    k1_half = int(np.around(k1 / 2.))
+
+    # pass 1: nearest neighbours and the max distance of every row
+    rank = np.empty((num, k1 + 1), dtype=np.int64)
+    row_max = np.empty(num, dtype=np.float32)
+    for start in range(0, num, block_size):
+        dist = _distance(features[start:start + block_size], features)
+        row_max[start:start + block_size] = dist.max(1)
+        rank[start:start + block_size] = topk(dist, k1 + 1)
+    mask = _reciprocal(rank, k1, block_size)
+    half_rank = rank[:, :k1_half + 1]
+    half_mask = _reciprocal(rank, k1_half, block_size)
+
+    # pass 2: weights of the expanded k-reciprocal sets, and the original query x gallery distances
+    final_dist = np.empty((m, n), dtype=np.float32)
+    rows, cols, values = [], [], []
+    for start in range(0, num, block_size):
+        stop = min(start + block_size, num)
+        dist = _distance(features[start:stop], features) / row_max[start:stop, np.newaxis]
+        if start < m:
+            final_dist[start:min(stop, m)] = dist[:m - start, m:] * lambda_value
+        index = _expansion(rank, mask, half_rank, half_mask, start, stop)
+        valid = index < num
+        weight = np.exp(-np.take_along_axis(dist, np.minimum(index, num - 1), 1)) * valid
+        weight /= weight.sum(1, keepdims=True)
+        rows.append(np.nonzero(valid)[0] + start)
+        cols.append(index[valid])
+        values.append(weight[valid].astype(np.float32))
+    V = sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(num, num))
+    del rows, cols, values
+    if k2 != 1:
+        # local query expansion: mean of the weights of the k2 nearest neighbours
+        expand = sparse.csr_matrix((np.full(num * k2, 1. / k2, dtype=np.float32),
+                                    (np.repeat(np.arange(num), k2), rank[:, :k2].ravel())), shape=(num, num))
+        V = expand.dot(V).tocsr()
+
+    # jaccard distance, sum_k min(V[i, k], V[j, k]) over the neighbours k shared by query i and gallery j
+    V_query = V[:m].tocoo()
+    V_gallery = V[m:].tocsc()
+    order = np.argsort(V_query.row, kind='stable')
+    q_row, q_col, q_val = V_query.row[order], V_query.col[order], V_query.data[order]
+    row_ptr = np.searchsorted(q_row, np.arange(m + 1))
+    query_block = _block_size(n, block_size)
+    for start in range(0, m, query_block):
+        stop = min(start + query_block, m)
+        sel = slice(row_ptr[start], row_ptr[stop])
+        count = np.diff(V_gallery.indptr)[q_col[sel]]
+        offset = np.repeat(V_gallery.indptr[q_col[sel]] - (np.cumsum(count) - count), count) + \
+                 np.arange(count.sum())
+        pair = np.repeat(q_row[sel] - start, count) * n + V_gallery.indices[offset]
+        temp_min = np.bincount(pair, weights=np.minimum(np.repeat(q_val[sel], count), V_gallery.data[offset]),
+                               minlength=(stop - start) * n).reshape(stop - start, n)
+        final_dist[start:stop] += (1 - temp_min / (2 - temp_min)) * (1 - lambda_value)
+    return final_dist
+
+
+def dense_rerank(query_features, gallery_features, k1=20, k2=6, lambda_value=0.3):
+    """Reference k-reciprocal re-ranking on dense ``(m + n) ^ 2`` matrices,
+    the common open-source implementation, for ``rerank_report``."""
+    x = np.asarray(to_numpy(query_features), dtype=np.float32)
+    y = np.asarray(to_numpy(gallery_features), dtype=np.float32)
+    query_num = len(x)
+    features = np.concatenate([x.reshape(len(x), -1), y.reshape(len(y), -1)])
+    original_dist = _distance(features, features)
+    all_num = original_dist.shape[0]
+    original_dist = np.transpose(original_dist / np.max(original_dist, axis=0))
+    V = np.zeros_like(original_dist).astype(np.float32)
+    initial_rank = np.argsort(original_dist, kind='stable').astype(np.int32)
+
+    for i in range(all_num):
+        forward_k_neigh_index = initial_rank[i, :k1 + 1]
+        backward_k_neigh_index = initial_rank[forward_k_neigh_index, :k1 + 1]
+        fi = np.where(backward_k_neigh_index == i)[0]
+        k_reciprocal_index = forward_k_neigh_index[fi]
+        k_reciprocal_expansion_index = k_reciprocal_index
+        for j in range(len(k_reciprocal_index)):
+            candidate = k_reciprocal_index[j]
+            candidate_forward_k_neigh_index = initial_rank[candidate, :int(np.around(k1 / 2.)) + 1]
+            candidate_backward_k_neigh_index = initial_rank[candidate_forward_k_neigh_index,
+                                                            :int(np.around(k1 / 2.)) + 1]
+            fi_candidate = np.where(candidate_backward_k_neigh_index == candidate)[0]
+            candidate_k_reciprocal_index = candidate_forward_k_neigh_index[fi_candidate]
+            if len(np.intersect1d(candidate_k_reciprocal_index, k_reciprocal_index)) > \
+                    2. / 3 * len(candidate_k_reciprocal_index):
+                k_reciprocal_expansion_index = np.append(k_reciprocal_expansion_index,
+                                                         candidate_k_reciprocal_index)
+        k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
+        weight = np.exp(-original_dist[i, k_reciprocal_expansion_index])
+        V[i, k_reciprocal_expansion_index] = weight / np.sum(weight)
+    original_dist = original_dist[:query_num, ]
+    if k2 != 1:
+        V_qe = np.zeros_like(V, dtype=np.float32)
+        for i in range(all_num):
+            V_qe[i, :] = np.mean(V[initial_rank[i, :k2], :], axis=0)
+        V = V_qe
+        del V_qe
+    del initial_rank
+    invIndex = []
+    for i in range(all_num):
+        invIndex.append(np.where(V[:, i] != 0)[0])
+
+    jaccard_dist = np.zeros_like(original_dist, dtype=np.float32)
+    for i in range(query_num):
+        temp_min = np.zeros(shape=[1, all_num], dtype=np.float32)
+        indNonZero = np.where(V[i, :] != 0)[0]
+        indImages = [invIndex[ind] for ind in indNonZero]
+        for j in range(len(indNonZero)):
+            temp_min[0, indImages[j]] = temp_min[0, indImages[j]] + np.minimum(V[i, indNonZero[j]],
+                                                                               V[indImages[j], indNonZero[j]])
+        jaccard_dist[i] = 1 - temp_min / (2 - temp_min)
+
+    final_dist = jaccard_dist * (1 - lambda_value) + original_dist * lambda_value
+    del original_dist, V, jaccard_dist
+    return final_dist[:query_num, query_num:]
+
+
+def rerank_report(query_features, gallery_features, k1=20, k2=6, lambda_value=0.3, block_size=0):
+    """Prints time and peak (numpy) memory of ``k_reciprocal_rerank`` against
+    ``dense_rerank`` and the largest difference of their distances."""
+    report = {}
+    results = {}
+    for name, func, kwargs in [('blocked', k_reciprocal_rerank, dict(block_size=block_size)),
+                               ('dense', dense_rerank, {})]:
+        tracemalloc.start()
+        tic = time.time()
+        results[name] = func(query_features, gallery_features, k1, k2, lambda_value, **kwargs)
+        toc = time.time() - tic
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        report[name] = {'time': toc, 'peak': peak}
+        print('Re-ranking [{:>7}]: {:.2f}s, peak memory {:.1f} MB'.format(name, toc, peak / 2 ** 20))
+    report['max_abs_diff'] = float(np.abs(results['blocked'] - results['dense']).max())
+    print('Re-ranking: max abs difference {:.2e}'.format(report['max_abs_diff']))
+    return report
@@ -0,0 +1,141 @@
+from __future__ import print_function, absolute_import
+import resource
+
+import numpy as np
+import torch
+
+from ..utils import to_torch
+
+
+def _block_distance(x, y, x_norm, y_norm):
+    # squared euclidean distance, as evaluators.pairwise_distance, counted in float32
+    return (x_norm.unsqueeze(1) + y_norm.unsqueeze(0) - 2 * x.mm(y.t())).float()
+
+
+def streaming_evaluate(query_features, gallery_features, query_ids, gallery_ids, query_cams, gallery_cams,
+                       topk=100, query_block=1024, gallery_block=16384, dtype=None, device=None,
+                       return_topk=0):
+    """mAP and CMC without materializing the query x gallery distance matrix.
+
+    Queries are processed in blocks of ``query_block`` against gallery blocks
+    of ``gallery_block``. A first pass gathers the distances of the true
+    matches of every query, a second pass counts the valid gallery samples
+    ranked before each of them, so only ``[query_block, gallery_block]``
+    distances and per-query match accumulators are held at once.
+
+    mAP equals ``mean_ap`` on the same distances (ties count as one
+    threshold). CMC ranks a match after the non-matches strictly closer than
+    it, which equals ``cmc`` unless distances tie exactly.
+
+    Args:
+        dtype: torch dtype of the distance computation, e.g. torch.float16 on
+            gpu or torch.bfloat16 on cpu, default is the feature dtype.
+        device: where to compute, default is the device of the features.
+        return_topk: also return the indices of the ``return_topk`` closest
+            valid gallery samples of every query, kept as a running top-k.
+
+    Returns:
+        (mAP, cmc_scores, topk_indices or None, peak bytes of the working set)
+    """
+    x, y = to_torch(query_features), to_torch(gallery_features)
+    device = torch.device(device) if device is not None else x.device
+    dtype = dtype or x.dtype
+    m, n = x.size(0), y.size(0)
+    x, y = x.view(m, -1), y.view(n, -1)
+    query_ids, gallery_ids = torch.as_tensor(np.asarray(query_ids)), torch.as_tensor(np.asarray(gallery_ids))
+    query_cams, gallery_cams = torch.as_tensor(np.asarray(query_cams)), torch.as_tensor(np.asarray(gallery_cams))
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+    gallery_blocks = []
+    for start in range(0, n, gallery_block):
+        y_block = y[start:start + gallery_block].to(device, dtype)
+        gallery_blocks.append((start, y_block, (y_block.float() ** 2).sum(1).to(dtype),
+                               gallery_ids[start:start + gallery_block].to(device),
+                               gallery_cams[start:start + gallery_block].to(device)))
+
+    aps = []
+    ret = np.zeros(topk)
+    num_valid_queries = 0
+    topk_indices = []
+    working_set = 0
+    for q_start in range(0, m, query_block):
+        x_block = x[q_start:q_start + query_block].to(device, dtype)
+        x_norm = (x_block.float() ** 2).sum(1).to(dtype)
+        q_ids = query_ids[q_start:q_start + query_block].to(device)
+        q_cams = query_cams[q_start:q_start + query_block].to(device)
+        num_q = x_block.size(0)
+
+        # pass 1: distances of the true matches (same id, other camera)
+        rows, values = [], []
+        for start, y_block, y_norm, g_ids, g_cams in gallery_blocks:
+            dist = _block_distance(x_block, y_block, x_norm, y_norm)
+            matches = (q_ids.unsqueeze(1) == g_ids.unsqueeze(0)) & (q_cams.unsqueeze(1) != g_cams.unsqueeze(0))
+            row, col = matches.nonzero(as_tuple=True)
+            rows.append(row)
+            values.append(dist[row, col])
+        rows, values = torch.cat(rows), torch.cat(values)
+        values, order = values.sort()
+        rows = rows[order]
+        # group by query, keeping the distance order: the keys are unique, so this
+        # needs no stable sort (torch < 1.9 has none, as cnn.py allows)
+        _, order = (rows * len(rows) + torch.arange(len(rows), device=device)).sort()
+        rows, values = rows[order], values[order]
+        num_pos = torch.bincount(rows, minlength=num_q)
+        max_pos = int(num_pos.max()) if len(rows) else 0
+        # [num_q, max_pos] sorted match distances, padded with inf
+        positives = torch.full((num_q, max(max_pos, 1)), float('inf'), device=device)
+        offsets = torch.cumsum(num_pos, 0) - num_pos
+        positives[rows, torch.arange(len(rows), device=device) - offsets[rows]] = values
+
+        # pass 2: valid samples closer than (or tied with) every match
+        ranked_before = torch.zeros_like(positives, dtype=torch.long)
+        ranked_with = torch.zeros_like(positives, dtype=torch.long)
+        run_dist = run_index = None
+        for start, y_block, y_norm, g_ids, g_cams in gallery_blocks:
+            dist = _block_distance(x_block, y_block, x_norm, y_norm)
+            # same id and same camera is not a valid gallery sample
+            invalid = (q_ids.unsqueeze(1) == g_ids.unsqueeze(0)) & (q_cams.unsqueeze(1) == g_cams.unsqueeze(0))
+            dist[invalid] = float('inf')
+            sorted_dist, index = dist.sort(dim=1)
+            # the whole block: distances before and after sorting, their order and the mask,
+            # plus the matches, both rank counters and the two searchsorted results
+            working_set = max(working_set, dist.numel() * (2 * dist.element_size() + index.element_size()) +
+                              invalid.numel() * invalid.element_size() +
+                              positives.numel() * (positives.element_size() + 4 * ranked_before.element_size()))
+            dist = sorted_dist
+            ranked_before += torch.searchsorted(dist, positives)
+            ranked_with += torch.searchsorted(dist, positives, right=True)
+            if return_topk:
+                dist, index = dist[:, :return_topk], index[:, :return_topk] + start
+                if run_dist is not None:
+                    dist, order = torch.cat([run_dist, dist], 1).sort(dim=1)
+                    index = torch.cat([run_index, index], 1).gather(1, order)
+                run_dist, run_index = dist[:, :return_topk], index[:, :return_topk]
+        if return_topk:
+            topk_indices.append(run_index.cpu())
+
+        has_pos = num_pos > 0
+        is_pos = torch.isfinite(positives)
+        # matches tied with or closer than each match, and strictly closer
+        pos_with = torch.searchsorted(positives, positives, right=True)
+        pos_before = torch.searchsorted(positives, positives)
+        precision = pos_with.double() / ranked_with.clamp(min=1).double()
+        ap = (precision * is_pos).sum(1)[has_pos] / num_pos[has_pos].double()
+        aps.append(ap.cpu().numpy())
+        # non-matches strictly closer than the first match
+        rank = (ranked_before[:, 0] - pos_before[:, 0])[has_pos].cpu().numpy()
+        ret += np.bincount(rank[rank < topk], minlength=topk)
+        num_valid_queries += int(has_pos.sum())
+
+    if num_valid_queries == 0:
+        raise RuntimeError("No valid query")
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = working_set
+    print('Streaming evaluation: {} x {} distances in {} x {} blocks, peak working set {:.1f} MB '
+          '(process max rss {:.1f} MB)'.format(m, n, query_block, gallery_block, peak / 2 ** 20,
+                                               resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10))
+    topk_indices = torch.cat(topk_indices).numpy() if return_topk else None
+    return np.mean(np.concatenate(aps)), ret.cumsum() / num_valid_queries, topk_indices, peak
@@ -5,27 +5,40 @@ from collections import OrderedDict
 import torch
 
 from .models import IDE_model
-from .evaluation_metrics import cmc, mean_ap
+from .evaluation_metrics import cmc, mean_ap, streaming_evaluate, parallel_evaluate, k_reciprocal_rerank, \
+    query_expansion
 from .feature_extraction import extract_cnn_feature
+from .feature_extraction.codec import codec_report
 from .utils.meters import AverageMeter
 
 
-def extract_features(model, data_loader, eval_only, print_freq=100):
+def extract_features(model, data_loader, eval_only, print_freq=100, flip=None):
+    """Returns ``(features, labels, index)``: a ``[N, D]`` tensor and the ``[N]``
+    pids in loader order, and ``{fname: row}``. Rows are written into a buffer
+    allocated once from the first batch."""
     model.eval()
     batch_time = AverageMeter()
     data_time = AverageMeter()
 
-    features = OrderedDict()
-    labels = OrderedDict()
+    num = len(data_loader.dataset)
+    features = None
+    labels = torch.empty(num, dtype=torch.long)
+    index = OrderedDict()
 
+    start = 0
     end = time.time()
     for i, (imgs, fnames, pids, _) in enumerate(data_loader):
         data_time.update(time.time() - end)
 
-        outputs = extract_cnn_feature(model, imgs, eval_only)
-        for fname, output, pid in zip(fnames, outputs, pids):
-            features[fname] = output
-            labels[fname] = pid
+        outputs = extract_cnn_feature(model, imgs, eval_only, flip=flip)
+        outputs = outputs.view(outputs.size(0), -1)
+        if features is None:
+            features = torch.empty(num, outputs.size(1), dtype=outputs.dtype)
+        stop = start + outputs.size(0)
+        features[start:stop] = outputs
+        labels[start:stop] = torch.as_tensor(pids)
+        index.update(zip(fnames, range(start, stop)))
+        start = stop
 
         batch_time.update(time.time() - end)
         end = time.time()
@@ -38,25 +51,35 @@ def extract_features(model, data_loader, eval_only, print_freq=100):
                           batch_time.val, batch_time.avg,
                           data_time.val, data_time.avg))
 
-    return features, labels
+    if features is None:
+        features = torch.empty(0, 0)
+    return features[:start], labels[:start], index
 
 
-def pairwise_distance(query_features, gallery_features, query=None, gallery=None):
-    x = torch.cat([query_features[f].unsqueeze(0) for f, _, _ in query], 0)
-    y = torch.cat([gallery_features[f].unsqueeze(0) for f, _, _ in gallery], 0)
+def align_features(features, index, items):
+    """Rows of ``features`` in the order of ``items`` ``(fname, pid, cam)``,
+    without a copy when the loader already followed that order."""
+    rows = [index[fname] for fname, _, _ in items]
+    if rows == list(range(features.size(0))):
+        return features
+    return features.index_select(0, torch.tensor(rows, dtype=torch.long))
+
+
+def pairwise_distance(x, y):
+    """Squared euclidean distances between the rows of ``x`` ``[m, D]`` and ``y`` ``[n, D]``."""
     m, n = x.size(0), y.size(0)
     x = x.view(m, -1)
     y = y.view(n, -1)
     dist = torch.pow(x, 2).sum(dim=1, keepdim=True).expand(m, n) + \
            torch.pow(y, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-    dist.addmm_(1, -2, x, y.t())
+    dist.addmm_(x, y.t(), beta=1, alpha=-2)
     return dist
 
 
 def evaluate_all(distmat, query=None, gallery=None,
                  query_ids=None, gallery_ids=None,
                  query_cams=None, gallery_cams=None,
-                 cmc_topk=(1, 5, 10)):
+                 cmc_topk=(1, 5, 10), num_workers=0):
     if query is not None and gallery is not None:
         query_ids = [pid for _, pid, _ in query]
         gallery_ids = [pid for _, pid, _ in gallery]
@@ -66,24 +89,30 @@ def evaluate_all(distmat, query=None, gallery=None,
         assert (query_ids is not None and gallery_ids is not None
                 and query_cams is not None and gallery_cams is not None)
 
-    # Compute mean AP
-    mAP = mean_ap(distmat, query_ids, gallery_ids, query_cams, gallery_cams)
-    # print('Mean AP: {:4.1%}'.format(mAP))
-
-    # Compute all kinds of CMC scores
-    cmc_configs = {
-        # 'allshots': dict(separate_camera_set=False,
-        #                  single_gallery_shot=False,
-        #                  first_match_break=False),
-        # 'cuhk03': dict(separate_camera_set=True,
-        #                single_gallery_shot=True,
-        #                first_match_break=False),
-        'market1501': dict(separate_camera_set=False,
-                           single_gallery_shot=False,
-                           first_match_break=True)}
-    cmc_scores = {name: cmc(distmat, query_ids, gallery_ids,
-                            query_cams, gallery_cams, **params)
-                  for name, params in cmc_configs.items()}
+    if num_workers > 1:
+        # queries split across processes, market1501 setting
+        mAP, cmc_scores = parallel_evaluate(distmat, query_ids, gallery_ids, query_cams, gallery_cams,
+                                            first_match_break=True, num_workers=num_workers)
+        cmc_scores = {'market1501': cmc_scores}
+    else:
+        # Compute mean AP
+        mAP = mean_ap(distmat, query_ids, gallery_ids, query_cams, gallery_cams)
+        # print('Mean AP: {:4.1%}'.format(mAP))
+
+        # Compute all kinds of CMC scores
+        cmc_configs = {
+            # 'allshots': dict(separate_camera_set=False,
+            #                  single_gallery_shot=False,
+            #                  first_match_break=False),
+            # 'cuhk03': dict(separate_camera_set=True,
+            #                single_gallery_shot=True,
+            #                first_match_break=False),
+            'market1501': dict(separate_camera_set=False,
+                               single_gallery_shot=False,
+                               first_match_break=True)}
+        cmc_scores = {name: cmc(distmat, query_ids, gallery_ids,
+                                query_cams, gallery_cams, **params)
+                      for name, params in cmc_configs.items()}
 
     print('[mAP: {:5.2%}], [cmc1: {:5.2%}], [cmc5: {:5.2%}], [cmc10: {:5.2%}]'
           .format(mAP, *cmc_scores['market1501'][[0, 4, 9]]))
@@ -92,15 +121,55 @@ def evaluate_all(distmat, query=None, gallery=None,
     return cmc_scores['market1501'][0]
 
 
+def evaluate_streaming(query_features, gallery_features, query, gallery, query_block=1024, gallery_block=16384,
+                       dtype=None):
+    mAP, cmc_scores, _, _ = streaming_evaluate(query_features, gallery_features,
+                                               [pid for _, pid, _ in query], [pid for _, pid, _ in gallery],
+                                               [cam for _, _, cam in query], [cam for _, _, cam in gallery],
+                                               query_block=query_block, gallery_block=gallery_block, dtype=dtype,
+                                               device='cuda' if torch.cuda.is_available() else 'cpu')
+    print('[mAP: {:5.2%}], [cmc1: {:5.2%}], [cmc5: {:5.2%}], [cmc10: {:5.2%}]'
+          .format(mAP, *cmc_scores[[0, 4, 9]]))
+    return cmc_scores[0]
+
+
 class Evaluator(object):
-    def __init__(self, model):
+    def __init__(self, model, flip=None, query_block=0, gallery_block=16384, dtype=None, num_workers=0,
+                 rerank=None, qe=None):
         super(Evaluator, self).__init__()
         self.model = model
-
-    def evaluate(self, query_loader, gallery_loader, query, gallery, metric=None, eval_only=True):
+        # flip test-time augmentation: None (or 'none'), 'avg' or 'concat'
+        self.flip = flip
+        # query_block > 0 evaluates block by block instead of on the full distance matrix
+        self.query_block = query_block
+        self.gallery_block = gallery_block
+        self.dtype = dtype
+        # num_workers > 1 ranks the queries in a process pool
+        self.num_workers = num_workers
+        # k-reciprocal re-ranking, None or the keyword arguments of k_reciprocal_rerank
+        self.rerank = rerank
+        # alpha query expansion / database augmentation, None or the keyword arguments of query_expansion
+        self.qe = qe
+
+    def evaluate(self, query_loader, gallery_loader, query, gallery, metric=None, eval_only=True, codecs=None):
         print('extracting query features\n')
-        query_features, _ = extract_features(self.model, query_loader, eval_only)
+        query_features, _, query_index = extract_features(self.model, query_loader, eval_only, flip=self.flip)
         print('extracting gallery features\n')
-        gallery_features, _ = extract_features(self.model, gallery_loader, eval_only)
-        distmat = pairwise_distance(query_features, gallery_features, query, gallery)
-        return evaluate_all(distmat, query=query, gallery=gallery)
+        gallery_features, _, gallery_index = extract_features(self.model, gallery_loader, eval_only, flip=self.flip)
+        query_features = align_features(query_features, query_index, query)
+        gallery_features = align_features(gallery_features, gallery_index, gallery)
+        if codecs:
+            # reconstruction error and mAP change of the feature storage codecs
+            codec_report(query_features.numpy(), gallery_features.numpy(),
+                         [pid for _, pid, _ in query], [pid for _, pid, _ in gallery],
+                         [cam for _, _, cam in query], [cam for _, _, cam in gallery], codecs)
+        if self.qe is not None:
+            query_features, gallery_features = query_expansion(query_features, gallery_features, **self.qe)
+        if self.rerank is not None:
+            distmat = k_reciprocal_rerank(query_features, gallery_features, **self.rerank)
+            return evaluate_all(distmat, query=query, gallery=gallery, num_workers=self.num_workers)
+        if self.query_block:
+            return evaluate_streaming(query_features, gallery_features, query, gallery, self.query_block,
+                                      self.gallery_block, self.dtype)
+        distmat = pairwise_distance(query_features, gallery_features)
+        return evaluate_all(distmat, query=query, gallery=gallery, num_workers=self.num_workers)
@@ -1,9 +1,21 @@
 from __future__ import absolute_import
 
 from .cnn import extract_cnn_feature
-from .database import FeatureDatabase
+from .database import FeatureDatabase, load_features
+from .ivf import IVFIndex
+from .shards import make_shards, claim_shard, merge_shards
+from .writer import FeatureWriter, AsyncFeatureWriter, read_manifest, trim_manifests
 
 __all__ = [
     'extract_cnn_feature',
     'FeatureDatabase',
+    'load_features',
+    'IVFIndex',
+    'FeatureWriter',
+    'AsyncFeatureWriter',
+    'read_manifest',
+    'trim_manifests',
+    'make_shards',
+    'claim_shard',
+    'merge_shards',
 ]
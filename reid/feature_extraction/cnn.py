@@ -1,24 +1,93 @@
 from __future__ import absolute_import
 from collections import OrderedDict
+import os
 import torch
 import numpy as np
+from torch import nn
 
 from ..models import PCB_model, IDE_model
-from torch.autograd import Variable
 
 from ..utils import to_torch
 
 
-def extract_cnn_feature(model, inputs, eval_only=True, modules=None):
+def inference_mode():
+    # torch.inference_mode is only available from torch 1.9 on
+    if hasattr(torch, 'inference_mode'):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def get_device(device='auto', num_threads=0, num_workers=0):
+    """Picks the inference device and sets the cpu thread pools.
+
+    Without an explicit ``num_threads``, intra-op threads use the cores left
+    over by the ``num_workers`` data loading processes, and a single inter-op
+    thread is used since batches run one after another.
+    """
+    if device == 'auto':
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = torch.device(device)
+    if device.type == 'cpu':
+        # cores this process may run on, fewer than cpu_count() for a pinned worker
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+        num_threads = num_threads or max(1, num_cores - num_workers)
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except (AttributeError, RuntimeError):
+            # older torch, or inter-op pool already started
+            pass
+    return device
+
+
+class _FeatureGraph(nn.Module):
+    def __init__(self, model):
+        super(_FeatureGraph, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x, True)[0]
+
+
+class TracedModel(nn.Module):
+    """Traced feature graph of ZJU_model / IDE_model / PCB_model.
+
+    Keeps the ``model(inputs, eval_only) -> (feat, predictions)`` interface, so
+    it can be passed wherever the eager model is used for inference.
+    """
+
+    def __init__(self, model, example):
+        super(TracedModel, self).__init__()
+        model.eval()
+        with torch.no_grad():
+            self.graph = torch.jit.trace(_FeatureGraph(model), example)
+
+    def forward(self, x, eval_only=True):
+        return self.graph(x), ()
+
+
+def extract_cnn_feature(model, inputs, eval_only=True, modules=None, flip=None):
+    """``flip='avg'`` or ``'concat'`` adds horizontally flipped copies to the
+    batch, both views go through a single forward pass and their features are
+    averaged or concatenated."""
     model.eval()
     inputs = to_torch(inputs)
-    inputs = Variable(inputs, requires_grad=False)
+    device = next(model.parameters()).device
+    inputs = inputs.to(device, non_blocking=True)
     if modules is None:
+        num_imgs = inputs.size(0)
+        if flip in ('avg', 'concat'):
+            inputs = torch.cat([inputs, inputs.flip(3)], 0)
         # if isinstance(model.module, IDE_model) or isinstance(model.module, PCB_model):
-        outputs = model(inputs, eval_only)
+        with inference_mode():
+            outputs = model(inputs, eval_only)
         outputs = outputs[0]
         # else:
         #     outputs = model(inputs)
+        if flip == 'avg':
+            outputs = (outputs[:num_imgs] + outputs[num_imgs:]) / 2
+        elif flip == 'concat':
+            outputs = torch.cat([outputs[:num_imgs], outputs[num_imgs:]], 1)
         outputs = outputs.data.cpu()
         return outputs
     # Register forward hook for each module
@@ -30,7 +99,8 @@ def extract_cnn_feature(model, inputs, eval_only=True, modules=None):
         def func(m, i, o): outputs[id(m)] = o.data.cpu()
 
         handles.append(m.register_forward_hook(func))
-    model(inputs)
+    with inference_mode():
+        model(inputs)
     for h in handles:
         h.remove()
     return list(outputs.values())
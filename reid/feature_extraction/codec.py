@@ -0,0 +1,65 @@
+from __future__ import print_function, absolute_import
+
+import numpy as np
+
+from ..evaluation_metrics import mean_ap
+
+CODECS = ['float64', 'float32', 'float16', 'int8']
+
+
+def is_quantized(codec):
+    return np.dtype(codec) in (np.float16, np.int8)
+
+
+def encode(emb, codec):
+    """Returns ``(data, scale)``, ``scale`` is the per-row scale of int8 and None otherwise."""
+    if np.dtype(codec) != np.int8:
+        return np.asarray(emb).astype(codec), None
+    emb = np.asarray(emb, dtype=np.float32)
+    scale = np.abs(emb).max(axis=1) / 127
+    scale[scale == 0] = 1
+    data = np.clip(np.round(emb / scale[:, np.newaxis]), -127, 127).astype(np.int8)
+    return data, scale.astype(np.float32)
+
+
+def decode(data, scale=None):
+    data = np.asarray(data)
+    if scale is None:
+        # float64 files stay float64
+        return data.astype(np.promote_types(data.dtype, np.float32))
+    return data.astype(np.float32) * np.asarray(scale, dtype=np.float32)[:, np.newaxis]
+
+
+def codec_error(emb, codec):
+    """Reconstruction error of ``emb`` through ``codec``: max absolute error,
+    mean relative l2 error and lowest cosine similarity of a row."""
+    emb = np.asarray(emb, dtype=np.float64)
+    rec = decode(*encode(emb, codec)).astype(np.float64)
+    norm = np.maximum(np.linalg.norm(emb, axis=1), 1e-12)
+    cosine = (emb * rec).sum(axis=1) / norm / np.maximum(np.linalg.norm(rec, axis=1), 1e-12)
+    return {'max_abs': float(np.abs(rec - emb).max()) if emb.size else 0.,
+            'rel_l2': float((np.linalg.norm(rec - emb, axis=1) / norm).mean()) if emb.size else 0.,
+            'min_cos': float(cosine.min()) if emb.size else 1.}
+
+
+def codec_report(query_features, gallery_features, query_ids, gallery_ids, query_cams, gallery_cams,
+                 codecs=CODECS):
+    """Prints the reconstruction error and the mAP change of every codec,
+    features are ``[num, dim]`` arrays, evaluated with euclidean distance."""
+
+    def distmat(x, y):
+        return (x ** 2).sum(1)[:, np.newaxis] + (y ** 2).sum(1)[np.newaxis, :] - 2 * x.dot(y.T)
+
+    x, y = np.asarray(query_features, dtype=np.float64), np.asarray(gallery_features, dtype=np.float64)
+    base_mAP = mean_ap(distmat(x, y), query_ids, gallery_ids, query_cams, gallery_cams)
+    report = {}
+    for codec in codecs:
+        error = codec_error(np.vstack([x, y]), codec)
+        x_rec, y_rec = decode(*encode(x, codec)), decode(*encode(y, codec))
+        mAP = mean_ap(distmat(x_rec.astype(np.float64), y_rec.astype(np.float64)),
+                      query_ids, gallery_ids, query_cams, gallery_cams)
+        report[codec] = dict(error, mAP=mAP, delta_mAP=mAP - base_mAP, bytes=np.dtype(codec).itemsize)
+        print('[{:>7}] {:d} bytes/value, max abs err {:.2e}, rel l2 err {:.2e}, min cos {:.6f}, '
+              'mAP {:5.2%} ({:+.3%})'.format(codec, np.dtype(codec).itemsize, error['max_abs'],
+                                              error['rel_l2'], error['min_cos'], mAP, mAP - base_mAP))
+    return report
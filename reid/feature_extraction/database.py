@@ -4,6 +4,8 @@ import h5py
 import numpy as np
 from torch.utils.data import Dataset
 
+from .codec import decode
+
 
 class FeatureDatabase(Dataset):
     def __init__(self, *args, **kwargs):
@@ -49,3 +51,27 @@ class FeatureDatabase(Dataset):
 
     def close(self):
         self.fid.close()
+
+
+def load_features(fpath, key='emb'):
+    """Reads a ``features%d.h5`` file written by either the old float64
+    ``save_file`` layout or by ``FeatureWriter``.
+
+    Files left behind by an interrupted ``FeatureWriter`` are still
+    preallocated, only the committed ``num_rows`` are returned. Quantized
+    files are dequantized to float32 ``[header, emb]`` rows.
+    """
+    with h5py.File(fpath, 'r') as fid:
+        data = fid[key]
+        num_rows = int(data.attrs.get('num_rows', data.shape[0]))
+        return read_rows(fid, 0, num_rows, key)
+
+
+def read_rows(fid, start, stop, key='emb'):
+    """Rows ``start:stop`` of an open ``features%d.h5`` file, dequantized
+    to float32 ``[header, emb]`` rows as ``load_features`` returns them."""
+    data = fid[key]
+    if 'header' not in fid:
+        return np.asarray(data[start:stop])
+    scale = fid['scale'][start:stop] if 'scale' in fid else None
+    return np.hstack([fid['header'][start:stop].astype(np.float32), decode(data[start:stop], scale)])
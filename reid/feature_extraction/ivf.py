@@ -0,0 +1,255 @@
+from __future__ import print_function, absolute_import
+import json
+import os.path as osp
+import re
+import time
+from glob import glob
+
+import numpy as np
+import torch
+
+from .database import load_features
+from ..utils.osutils import mkdir_if_missing
+
+
+def _distance(x, y):
+    # squared euclidean distance, as evaluators.pairwise_distance
+    return (x ** 2).sum(1, keepdim=True) + (y ** 2).sum(1).unsqueeze(0) - 2 * x.mm(y.t())
+
+
+def _rows(d, budget=2 ** 24):
+    # rows of an [rows, d] block of about ``budget`` elements
+    return max(1, budget // max(d, 1))
+
+
+def _assign(x, centroids):
+    # nearest centroid of every row, in blocks of rows
+    assign = torch.empty(len(x), dtype=torch.long)
+    # the norm of x does not change the argmin
+    norm = (centroids ** 2).sum(1)
+    block = _rows(len(centroids))
+    for start in range(0, len(x), block):
+        assign[start:start + block] = torch.addmm(norm, x[start:start + block], centroids.t(), alpha=-2).argmin(1)
+    return assign
+
+
+def kmeans(x, k, num_iter=20, seed=0):
+    """Lloyd's k-means on the rows of a float tensor ``x``, empty clusters are
+    restarted from random rows. Returns the ``[k, d]`` centroids."""
+    n = len(x)
+    if n < k:
+        raise ValueError("k-means needs at least {} rows, got {}".format(k, n))
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(n, generator=generator)[:k]].clone()
+    for _ in range(num_iter):
+        assign = _assign(x, centroids)
+        counts = torch.bincount(assign, minlength=k)
+        centroids = torch.zeros_like(centroids).index_add_(0, assign, x) / counts.clamp(min=1).unsqueeze(1).to(x)
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = x[torch.randint(n, (int(empty.sum()),), generator=generator)]
+    return centroids
+
+
+class IVFIndex(object):
+    """Inverted-file index over squared euclidean distances, with optional
+    product quantization of the residuals (IVF-PQ).
+
+    The vectors are clustered into ``num_lists`` coarse k-means lists and
+    stored list by list. A search visits the ``nprobe`` lists closest to
+    every query: with ``num_subspaces=0`` the stored vectors are compared
+    exactly, otherwise every vector is ``num_subspaces`` uint8 codes of its
+    residual and distances come from per-query lookup tables (ADC). All
+    queries probing a list are handled together, so a batch costs one small
+    matrix product per visited list.
+
+    ``save`` writes the arrays as ``.npy`` files, ``load`` memory-maps them.
+
+    Args:
+        num_lists: number of coarse lists.
+        num_subspaces: PQ sub-vectors per vector, 0 stores the vectors as float32.
+        num_centroids: centroids per PQ sub-space, at most 256.
+    """
+
+    def __init__(self, num_lists=1024, num_subspaces=0, num_centroids=256):
+        super(IVFIndex, self).__init__()
+        assert num_centroids <= 256, "PQ codes are uint8"
+        self.num_lists = num_lists
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.centroids = None
+        self.codebooks = None
+        self.offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.data = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, x, num_iter=20, max_samples=256, seed=0):
+        """Learns the coarse centroids and the PQ codebooks on a sample of at
+        most ``max_samples`` rows per centroid."""
+        x = torch.as_tensor(np.asarray(x, dtype=np.float32))
+        if self.num_subspaces:
+            assert x.size(1) % self.num_subspaces == 0, "the dimension must split into num_subspaces"
+        generator = torch.Generator().manual_seed(seed)
+        num_samples = max_samples * max(self.num_lists, self.num_centroids if self.num_subspaces else 0)
+        if len(x) > num_samples:
+            x = x[torch.randperm(len(x), generator=generator)[:num_samples]]
+        centroids = kmeans(x, self.num_lists, num_iter, seed)
+        if self.num_subspaces:
+            residual = (x - centroids[_assign(x, centroids)]).view(len(x), self.num_subspaces, -1)
+            self.codebooks = torch.stack([kmeans(residual[:, m].contiguous(), self.num_centroids, num_iter, seed)
+                                          for m in range(self.num_subspaces)]).numpy()
+        self.centroids = centroids.numpy()
+        return self
+
+    def _encode(self, residual):
+        residual = residual.view(len(residual), self.num_subspaces, -1)
+        codebooks = torch.as_tensor(np.array(self.codebooks))
+        return torch.stack([_assign(residual[:, m].contiguous(), codebooks[m])
+                            for m in range(self.num_subspaces)], 1).to(torch.uint8).numpy()
+
+    def add(self, x, ids=None):
+        """Adds the rows of ``x``, ``ids`` default to their position, counted
+        after the vectors already in the index."""
+        assert self.is_trained, "train the index first"
+        x = torch.as_tensor(np.asarray(x, dtype=np.float32))
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(x))
+        centroids = torch.as_tensor(np.array(self.centroids))
+        assign = _assign(x, centroids)
+        if self.num_subspaces:
+            data = self._encode(x - centroids[assign])
+        else:
+            data = x.numpy()
+        # merge with the stored lists, every list stays contiguous
+        old_assign = np.repeat(np.arange(self.num_lists), np.diff(self.offsets))
+        assign = np.concatenate([old_assign, assign.numpy()])
+        order = np.argsort(assign, kind='stable')
+        self.ids = np.concatenate([np.asarray(self.ids), np.asarray(ids, dtype=np.int64)])[order]
+        self.data = (np.concatenate([np.asarray(self.data), data]) if self.data is not None else data)[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=self.num_lists))])
+        return self
+
+    def _list_distance(self, queries, centroid, start, stop):
+        data = torch.as_tensor(np.array(self.data[start:stop]))
+        if not self.num_subspaces:
+            return _distance(queries, data)
+        # asymmetric distance: lookup table of the query residual against every sub-space centroid
+        residual = (queries - centroid).view(len(queries), self.num_subspaces, -1)
+        codebooks = torch.as_tensor(np.array(self.codebooks))
+        table = (residual ** 2).sum(2, keepdim=True) + (codebooks ** 2).sum(2).unsqueeze(0) - \
+                2 * torch.einsum('qmd,mcd->qmc', residual, codebooks)
+        codes = data.long().t().unsqueeze(0).expand(len(queries), -1, -1)
+        return table.gather(2, codes).sum(1)
+
+    def search(self, queries, k=10, nprobe=8):
+        """Returns ``(distances, ids)``, both ``[num_queries, k]`` sorted by
+        distance, padded with inf and -1 when fewer than ``k`` rows are probed."""
+        assert self.is_trained, "train the index first"
+        queries = torch.as_tensor(np.asarray(queries, dtype=np.float32))
+        queries = queries.view(len(queries), -1)
+        num = len(queries)
+        nprobe = min(nprobe, self.num_lists)
+        centroids = torch.as_tensor(np.array(self.centroids))
+        probe = _distance(queries, centroids).topk(nprobe, 1, largest=False)[1]
+
+        # the k best of every probed list, in the slot of its probe rank
+        dist = torch.full((num, nprobe, k), float('inf'))
+        ids = torch.full((num, nprobe, k), -1, dtype=torch.long)
+        flat = probe.view(-1).numpy()
+        order = torch.as_tensor(np.argsort(flat, kind='stable'))
+        bounds = np.searchsorted(flat[order.numpy()], np.arange(self.num_lists + 1)).tolist()
+        offsets = self.offsets.tolist()
+        for l in range(self.num_lists):
+            start, stop = offsets[l], offsets[l + 1]
+            if bounds[l] == bounds[l + 1] or start == stop:
+                continue
+            probed = order[bounds[l]:bounds[l + 1]]
+            list_ids = torch.as_tensor(np.array(self.ids[start:stop]))
+            kk = min(k, stop - start)
+            block = _rows((stop - start) * max(self.num_subspaces, 1))
+            for b in range(0, len(probed), block):
+                query_index, slot = probed[b:b + block] // nprobe, probed[b:b + block] % nprobe
+                d, i = self._list_distance(queries[query_index], centroids[l], start, stop).topk(kk, 1, largest=False)
+                dist[query_index, slot, :kk] = d
+                ids[query_index, slot, :kk] = list_ids[i]
+        dist, i = dist.view(num, -1).topk(k, 1, largest=False)
+        return dist.numpy(), ids.view(num, -1).gather(1, i).numpy()
+
+    def save(self, folder):
+        mkdir_if_missing(folder)
+        for name in ['centroids', 'offsets', 'ids', 'data'] + (['codebooks'] if self.num_subspaces else []):
+            np.save(osp.join(folder, name + '.npy'), np.asarray(getattr(self, name)))
+        with open(osp.join(folder, 'index.json'), 'w') as fp:
+            json.dump({'num_lists': self.num_lists, 'num_subspaces': self.num_subspaces,
+                       'num_centroids': self.num_centroids}, fp, indent=1)
+
+    @classmethod
+    def load(cls, folder, mmap=True):
+        """Loads an index written by ``save``, the arrays are memory-mapped
+        read-only with ``mmap=True``."""
+        with open(osp.join(folder, 'index.json'), 'r') as fp:
+            index = cls(**json.load(fp))
+        for name in ['centroids', 'offsets', 'ids', 'data'] + (['codebooks'] if index.num_subspaces else []):
+            setattr(index, name, np.load(osp.join(folder, name + '.npy'), mmap_mode='r' if mmap else None))
+        return index
+
+
+def read_feature_folder(folder, num_header=2):
+    """Stacks the ``features<cam>.h5`` files of a folder in camera order.
+    Returns ``(header, emb)``, ``num_header`` is 2 for detections and 3 otherwise."""
+    fpaths = sorted(glob(osp.join(folder, 'features*.h5')),
+                    key=lambda fpath: int(re.search(r'features(\d+)\.h5$', fpath).group(1)))
+    data = [load_features(fpath) for fpath in fpaths]
+    data = np.concatenate(data) if data else np.zeros([0, num_header])
+    return data[:, :num_header].astype(np.int64), np.ascontiguousarray(data[:, num_header:], dtype=np.float32)
+
+
+def read_database(database, keys=None):
+    """Returns ``(keys, emb)``, one flattened row per key of a FeatureDatabase."""
+    keys = list(database) if keys is None else list(keys)
+    return keys, np.stack([np.asarray(database[key], dtype=np.float32).reshape(-1) for key in keys])
+
+
+def exact_search(base, queries, k=10):
+    """Brute-force ``(distances, indices)`` of the ``k`` nearest rows of ``base``."""
+    base = torch.as_tensor(np.asarray(base, dtype=np.float32))
+    queries = torch.as_tensor(np.asarray(queries, dtype=np.float32))
+    dist = torch.empty(len(queries), min(k, len(base)))
+    index = torch.empty(len(queries), min(k, len(base)), dtype=torch.long)
+    block = _rows(len(base))
+    for start in range(0, len(queries), block):
+        dist[start:start + block], index[start:start + block] = \
+            _distance(queries[start:start + block], base).topk(min(k, len(base)), 1, largest=False)
+    return dist.numpy(), index.numpy()
+
+
+def recall_benchmark(index, base, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+    """recall@k and latency of ``index.search`` against ``exact_search``.
+
+    The index ids must be the row positions in ``base``. Returns a list of
+    ``{'nprobe', 'recall', 'seconds', 'qps'}``, the exact search has nprobe 0.
+    """
+    tic = time.time()
+    _, truth = exact_search(base, queries, k)
+    toc = time.time() - tic
+    results = [{'nprobe': 0, 'recall': 1., 'seconds': toc, 'qps': len(queries) / max(toc, 1e-12)}]
+    print('exact      : recall@{} 1.0000, {:.3f}s, {:.0f} queries/s'.format(k, toc, results[0]['qps']))
+    for nprobe in nprobes:
+        if nprobe > index.num_lists:
+            break
+        tic = time.time()
+        _, ids = index.search(queries, k, nprobe)
+        toc = time.time() - tic
+        hits = (ids[:, :, np.newaxis] == truth[:, np.newaxis, :]).any(2).sum(1)
+        recall = float(hits.mean() / truth.shape[1])
+        results.append({'nprobe': nprobe, 'recall': recall, 'seconds': toc, 'qps': len(queries) / max(toc, 1e-12)})
+        print('nprobe {:4d}: recall@{} {:.4f}, {:.3f}s, {:.0f} queries/s'.format(nprobe, k, recall, toc,
+                                                                               results[-1]['qps']))
+    return results
@@ -0,0 +1,195 @@
+from __future__ import absolute_import
+import errno
+import os
+import os.path as osp
+import socket
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from .database import read_rows
+from .writer import FeatureWriter, read_manifest
+from ..utils.osutils import mkdir_if_missing
+
+
+def make_shards(cams, shard_size=0):
+    """Splits crops into shards of a single camera and consecutive frames.
+
+    ``cams`` holds the camera of every crop, in dataset order. Returns an
+    ordered ``{name: indices}``, names ``c<cam>_<chunk>`` sort like the rows of
+    the merged ``features<cam>.h5``. ``shard_size=0`` makes one shard per camera.
+    """
+    cams = np.asarray(cams, dtype=np.int64)
+    shards = OrderedDict()
+    for cam in np.unique(cams):
+        index = np.nonzero(cams == cam)[0]
+        num_chunks = int(np.ceil(len(index) / float(shard_size))) if shard_size else 1
+        for chunk, chunk_index in enumerate(np.array_split(index, num_chunks)):
+            shards['c{:02d}_{:04d}'.format(cam, chunk)] = chunk_index
+    return shards
+
+
+def shard_cam(name):
+    return int(name.split('_')[0][1:])
+
+
+def _create_exclusive(fpath):
+    # the lock is written to a private file and linked into place, the link is atomic on
+    # local disks and on NFS and fails if the lock exists, so exactly one worker wins and
+    # no worker ever sees the lock without its owner
+    tmp_fpath = '{}.{}.{}'.format(fpath, socket.gethostname(), os.getpid())
+    with open(tmp_fpath, 'w') as fp:
+        fp.write('{} {}\n'.format(socket.gethostname(), os.getpid()))
+    try:
+        os.link(tmp_fpath, fpath)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    finally:
+        os.remove(tmp_fpath)
+    return True
+
+
+def _owner_alive(fpath):
+    # the owner of a lock on this host is alive while its pid exists; owners on
+    # other hosts cannot be checked and are taken as alive
+    try:
+        with open(fpath) as fp:
+            host, pid = fp.read().split()
+        pid = int(pid)
+    except (IOError, OSError, ValueError):
+        # lock of an older version, written after its creation
+        return False
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _take_over(fpath, before=None):
+    """Replaces the lock ``fpath`` of a crashed owner, False if it is held.
+
+    The owner is crashed if it is a dead process of this host or, with
+    ``before``, if the lock is older than that time (``--reclaim``, for
+    owners on other hosts). The stale lock is renamed away first, so of
+    several workers taking it over at the same time only one gets it. A
+    worker that renamed the fresh lock of the winner instead puts it back.
+    """
+    try:
+        inspected = os.stat(fpath)
+    except OSError:
+        # released meanwhile
+        return _create_exclusive(fpath)
+    stale = before is not None and inspected.st_mtime < before
+    if not stale and _owner_alive(fpath):
+        return False
+    stale_fpath = '{}.stale.{}.{}'.format(fpath, socket.gethostname(), os.getpid())
+    try:
+        os.rename(fpath, stale_fpath)
+    except OSError:
+        return False
+    moved = os.stat(stale_fpath)
+    if (moved.st_ino, moved.st_mtime) != (inspected.st_ino, inspected.st_mtime):
+        # another worker took the lock over between the check and the rename
+        try:
+            os.link(stale_fpath, fpath)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.remove(stale_fpath)
+        return False
+    os.remove(stale_fpath)
+    return _create_exclusive(fpath)
+
+
+def claim_shard(lock_dir, name, reclaim_before=None):
+    """Claims a shard for this process, False if it is done or another worker holds it.
+
+    The lock file ``<name>.lock`` holds the host and pid of its owner. The lock
+    of an unfinished shard whose owner died on this host is taken over, its new
+    owner resumes from the manifest. ``reclaim_before`` also takes over the
+    unfinished shards locked before that time, by workers of other hosts.
+    """
+    mkdir_if_missing(lock_dir)
+    fpath = osp.join(lock_dir, name + '.lock')
+    if _create_exclusive(fpath):
+        return True
+    if osp.isfile(osp.join(lock_dir, name + '.done')):
+        return False
+    return _take_over(fpath, reclaim_before)
+
+
+def mark_done(lock_dir, name):
+    open(osp.join(lock_dir, name + '.done'), 'w').close()
+
+
+def all_done(lock_dir, names):
+    return all(osp.isfile(osp.join(lock_dir, name + '.done')) for name in names)
+
+
+def claim_merge(lock_dir, reclaim_before=None):
+    """Claims the merge of the shards, False if it is done or another worker runs it."""
+    fpath = osp.join(lock_dir, 'merge.lock')
+    if _create_exclusive(fpath):
+        return True
+    if merged(lock_dir):
+        return False
+    return _take_over(fpath, reclaim_before)
+
+
+def merged(lock_dir):
+    return osp.isfile(osp.join(lock_dir, 'merge.done'))
+
+
+def mark_merged(lock_dir):
+    open(osp.join(lock_dir, 'merge.done'), 'w').close()
+
+
+def release_merge(lock_dir):
+    # a failed merge can be run again by the next worker
+    try:
+        os.remove(osp.join(lock_dir, 'merge.lock'))
+    except OSError:
+        pass
+
+
+def merge_shards(folder, shard_folders, num_cams, dtype='float32', compression=None, num_header=0,
+                 chunk_rows=65536):
+    """Concatenates the per-shard ``features<cam>.h5`` files into ``folder``.
+
+    ``shard_folders`` is an ordered ``{name: folder}``, the rows of every camera
+    are written in shard order, so the result does not depend on which worker
+    extracted which shard. The manifests are merged as well. Rows are copied
+    ``chunk_rows`` at a time, shards stored with ``dtype`` without decoding them.
+    """
+    manifests = OrderedDict((name, read_manifest(osp.join(shard_folder, 'manifest.txt')))
+                            for name, shard_folder in shard_folders.items())
+    num_rows = np.zeros(num_cams, dtype=np.int64)
+    for committed in manifests.values():
+        for cam, keys in committed.items():
+            num_rows[cam - 1] += len(keys)
+    writer = FeatureWriter(folder, num_rows, dtype=dtype, compression=compression,
+                           manifest=osp.join(folder, 'manifest.txt'), num_header=num_header)
+    for name, shard_folder in shard_folders.items():
+        cam = shard_cam(name)
+        keys = manifests[name].get(cam, [])
+        if not keys:
+            continue
+        with h5py.File(osp.join(shard_folder, 'features%d.h5' % cam), 'r') as fid:
+            raw = fid['emb'].attrs.get('codec') == writer.dtype.name and \
+                  ('header' in fid) == writer.quantized
+            for start in range(0, len(keys), chunk_rows):
+                stop = min(start + chunk_rows, len(keys))
+                if raw:
+                    writer.write_encoded(cam, {key: fid[key][start:stop] for key in ('header', 'emb', 'scale')
+                                               if key in fid}, keys[start:stop])
+                else:
+                    writer.write(cam, read_rows(fid, start, stop), keys[start:stop])
+                writer.flush()
+    writer.close()
+    return num_rows
@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+import queue
+import threading
+import traceback
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from ..prepare.extract_bbox import read_bboxs, iter_crops, get_crop_name
+
+
+def threaded(generator, max_queue=8):
+    """Runs a generator in a background thread, items are handed over
+    through a queue of ``max_queue`` items so a slow consumer throttles it."""
+    items = queue.Queue(maxsize=max_queue)
+    done = object()
+
+    def run():
+        try:
+            for item in generator:
+                items.put(item)
+        except Exception:
+            items.put(RuntimeError('pipeline stage failed:\n{}'.format(traceback.format_exc())))
+        items.put(done)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, RuntimeError):
+            raise item
+        yield item
+
+
+class VideoCropLoader(object):
+    """Cuts crops straight from the videos and batches them for inference.
+
+    Yields the ``(imgs, fnames, pids, cams, info)`` batches of a DataLoader
+    over a ``Preprocessor`` with info, without writing and decoding a JPEG
+    per crop. The features are equivalent to those of the crops of
+    ``reid/prepare/extract_bbox.py`` up to JPEG re-encoding: those crops are
+    lossy copies of the frames cut here, so the two differ slightly and are
+    not interchangeable bit for bit (e.g. one gallery should not mix both).
+    ``fnames`` are the names those crops would have, crops named in ``skip``
+    are left out.
+
+    Decoding, cutting and transforming, and batching run as generator
+    stages in their own threads, connected by bounded queues.
+
+    Args:
+        cameras: ``(iCam, video_file, bbox_filename, delimiter)`` as returned by
+            ``reid.prepare.extract_bbox.get_cameras``.
+        transform: test transform, applied on RGB PIL images.
+        type: 'det', 'gt' or 'labeled', as in ``extract_bbox.get_bbox``.
+        fps: gt frame rate, as in ``extract_bbox.get_bbox``.
+    """
+
+    def __init__(self, cameras, transform, type='det', fps=10, batch_size=64, max_queue=8, skip=None):
+        self.transform = transform
+        self.type = type
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.skip = skip or set()
+        self.cameras = []
+        for iCam, video_file, bbox_filename, delimiter in cameras:
+            video_reader = cv2.VideoCapture(video_file)
+            width = video_reader.get(cv2.CAP_PROP_FRAME_WIDTH)
+            height = video_reader.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            video_reader.release()
+            self.cameras.append((iCam, video_file, read_bboxs(bbox_filename, delimiter, width, height, type, fps)))
+
+    @property
+    def num_rows(self):
+        # upper bound of the crops per camera, empty and skipped bboxs are not counted out
+        num_rows = np.zeros(max([iCam for iCam, _, _ in self.cameras] + [0]), dtype=np.int64)
+        for iCam, _, bboxs in self.cameras:
+            num_rows[iCam - 1] += len(bboxs)
+        return num_rows
+
+    def __len__(self):
+        return int(np.ceil(self.num_rows.sum() / float(self.batch_size)))
+
+    def _crops(self):
+        for iCam, video_file, bboxs in self.cameras:
+            video_reader = cv2.VideoCapture(video_file)
+            for frame, pid, index, crop in iter_crops(video_reader, bboxs):
+                fname = get_crop_name(self.type, iCam, frame, pid, index)
+                if self.type == 'det':
+                    # as parsed by the datasets: detections have no identity
+                    pid = 1
+                elif pid == -1:
+                    continue
+                if fname not in self.skip:
+                    yield crop, fname, pid, iCam, frame
+            video_reader.release()
+
+    def _samples(self, crops):
+        for crop, fname, pid, iCam, frame in crops:
+            # opencv decodes to BGR, the models are trained on RGB PIL images
+            img = Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB))
+            yield self.transform(img), fname, pid, iCam, frame
+
+    def _batches(self, samples):
+        batch = []
+        for sample in samples:
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield self._collate(batch)
+                batch = []
+        if batch:
+            yield self._collate(batch)
+
+    def _collate(self, batch):
+        imgs, fnames, pids, cams, frames = zip(*batch)
+        info = torch.from_numpy(np.stack([pids, cams, frames], axis=1).astype(np.int64))
+        return torch.stack(imgs), list(fnames), torch.tensor(pids), torch.tensor(cams) - 1, info
+
+    def __iter__(self):
+        crops = threaded(self._crops(), self.max_queue * self.batch_size)
+        samples = threaded(self._samples(crops), self.max_queue * self.batch_size)
+        return threaded(self._batches(samples), self.max_queue)
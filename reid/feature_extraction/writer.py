@@ -0,0 +1,303 @@
+from __future__ import absolute_import
+import os
+import os.path as osp
+import queue
+import threading
+import time
+import traceback
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from .codec import encode, is_quantized
+from ..utils.osutils import mkdir_if_missing
+
+
+def read_manifest(fpath):
+    """Returns the crops committed to a writer manifest, ``{cam: [key, ...]}``
+    in the order of their rows in ``features<cam>.h5``."""
+    committed = OrderedDict()
+    if not osp.isfile(fpath):
+        return committed
+    with open(fpath, 'r') as fp:
+        for line in fp:
+            # a line cut by a crash has no newline and was never committed
+            if not line.endswith('\n'):
+                break
+            cam, key = line.rstrip('\n').split(' ', 1)
+            committed.setdefault(int(cam), []).append(key)
+    return committed
+
+
+def trim_manifests(fpaths):
+    """Cuts the manifests of outputs written in lockstep by the same run to
+    their common per-camera prefix, returns the keys committed to all of them."""
+    manifests = [read_manifest(fpath) for fpath in fpaths]
+    cams = set(cam for committed in manifests for cam in committed)
+    num_committed = {cam: min(len(committed.get(cam, [])) for committed in manifests) for cam in cams}
+    for fpath, committed in zip(fpaths, manifests):
+        if all(len(keys) == num_committed[cam] for cam, keys in committed.items()):
+            continue
+        with open(fpath, 'w') as fp:
+            for cam, keys in committed.items():
+                fp.writelines('{} {}\n'.format(cam, key) for key in keys[:num_committed[cam]])
+    if not manifests:
+        return set()
+    return set(key for cam, keys in manifests[0].items() for key in keys[:num_committed[cam]])
+
+
+class FeatureWriter(object):
+    """Writes per-camera ``features%d.h5`` files for the tracker.
+
+    Every camera file is opened once, its ``emb`` dataset is preallocated
+    from the expected number of rows and chunked along rows (the tracker
+    reads consecutive frames), and it is trimmed to the rows actually written
+    when the writer is closed.
+
+    With a float16 or int8 ``dtype`` (see ``codec.py``), the first
+    ``num_header`` columns of the rows go to an int32 ``header`` dataset,
+    ``emb`` holds the quantized features and int8 stores a per-row ``scale``.
+    ``load_features`` dequantizes them.
+
+    When ``manifest`` is given, the keys (crop file names) of the rows are
+    appended to it at every ``flush()``, after the h5 files are flushed. With
+    ``resume=True`` the committed rows of a previous run are kept, anything
+    written after its last flush is dropped, and new rows are appended.
+
+    Args:
+        folder: output folder, files are named ``features<cam>.h5``.
+        num_rows: expected (new) rows per camera, ``num_rows[cam - 1]``.
+        dtype: storage dtype of ``emb``, float32 by default, float16 or int8 to quantize.
+        compression: None, 'gzip' or 'lzf'.
+        chunk_rows: number of rows per hdf5 chunk.
+        manifest: path of the manifest file, None disables it.
+        resume: continue the files listed in ``manifest``.
+        num_header: header columns of the rows, required to quantize.
+    """
+
+    def __init__(self, folder, num_rows, dtype='float32', compression=None, chunk_rows=256,
+                 manifest=None, resume=False, num_header=0):
+        self.folder = folder
+        self.num_rows = [int(n) for n in num_rows]
+        self.dtype = np.dtype(dtype)
+        self.quantized = is_quantized(dtype)
+        if self.quantized and not num_header:
+            raise ValueError("num_header is required to store {} features".format(dtype))
+        self.num_header = num_header
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self.cursor = [0 for _ in self.num_rows]
+        self.fids = {}
+        self.manifest = manifest
+        self.pending = []
+        mkdir_if_missing(folder)
+        if manifest is not None and not resume and osp.isfile(manifest):
+            os.remove(manifest)
+        if resume and manifest is not None and osp.isfile(manifest):
+            for cam, keys in read_manifest(manifest).items():
+                self._reopen(cam, len(keys))
+            # drop a line cut by a crash before appending to the manifest again
+            with open(manifest, 'rb+') as fp:
+                fp.truncate(fp.read().rfind(b'\n') + 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def fpath(self, cam):
+        return osp.join(self.folder, 'features%d.h5' % cam)
+
+    def _create(self, fid, key, num_rows, shape, dtype):
+        chunks = (min(self.chunk_rows, num_rows),) + shape
+        return fid.create_dataset(key, shape=(num_rows,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                                  chunks=chunks, compression=self.compression)
+
+    def _open(self, cam, dim):
+        num_rows = max(self.num_rows[cam - 1], 1)
+        fid = h5py.File(self.fpath(cam), 'w')
+        if self.quantized:
+            self._create(fid, 'header', num_rows, (self.num_header,), np.int32)
+            emb = self._create(fid, 'emb', num_rows, (dim - self.num_header,), self.dtype)
+            if self.dtype == np.int8:
+                self._create(fid, 'scale', num_rows, (), np.float32)
+        else:
+            emb = self._create(fid, 'emb', num_rows, (dim,), self.dtype)
+        emb.attrs['codec'] = self.dtype.name
+        emb.attrs['num_rows'] = 0
+        self.fids[cam] = fid
+        return fid
+
+    @staticmethod
+    def _resize(fid, num_rows):
+        for key in ('header', 'emb', 'scale'):
+            if key in fid:
+                fid[key].resize(num_rows, axis=0)
+
+    def _reopen(self, cam, committed):
+        fid = h5py.File(self.fpath(cam), 'a')
+        emb = fid['emb']
+        if emb.shape[0] < committed:
+            fid.close()
+            raise ValueError("{} holds {} rows, but its manifest lists {}"
+                             .format(self.fpath(cam), emb.shape[0], committed))
+        # drop rows written after the last committed flush, then make room for the new ones
+        self._resize(fid, committed + self.num_rows[cam - 1])
+        emb.attrs['num_rows'] = committed
+        self.cursor[cam - 1] = committed
+        self.fids[cam] = fid
+
+    def write(self, cam, rows, keys=None):
+        rows = np.asarray(rows)
+        if rows.ndim == 1:
+            rows = rows[np.newaxis, :]
+        if not len(rows):
+            return
+        fid, start, stop = self._reserve(cam, len(rows), rows.shape[1])
+        emb = fid['emb']
+        if self.quantized:
+            fid['header'][start:stop] = rows[:, :self.num_header]
+            data, scale = encode(rows[:, self.num_header:], self.dtype)
+            emb[start:stop] = data
+            if scale is not None:
+                fid['scale'][start:stop] = scale
+        else:
+            emb[start:stop] = rows
+        self._advance(cam, stop, keys)
+
+    def _reserve(self, cam, num, dim):
+        fid = self.fids[cam] if cam in self.fids else self._open(cam, dim)
+        start = self.cursor[cam - 1]
+        stop = start + num
+        if stop > fid['emb'].shape[0]:
+            # more rows than announced, grow geometrically instead of per write
+            self._resize(fid, max(stop, 2 * fid['emb'].shape[0]))
+        return fid, start, stop
+
+    def _advance(self, cam, stop, keys):
+        self.cursor[cam - 1] = stop
+        if self.manifest is not None:
+            if keys is None:
+                raise ValueError("keys are required when writing with a manifest")
+            self.pending.extend('{} {}\n'.format(cam, key) for key in keys)
+
+    def write_encoded(self, cam, parts, keys=None):
+        """Appends rows already stored with this writer's ``dtype``.
+
+        ``parts`` maps the datasets of a ``FeatureWriter`` file (``emb`` and,
+        when quantized, ``header`` and ``scale``) to their rows, which are
+        copied as they are, without decoding and encoding them again.
+        """
+        emb = np.asarray(parts['emb'])
+        if not len(emb):
+            return
+        dim = emb.shape[1] + (self.num_header if self.quantized else 0)
+        fid, start, stop = self._reserve(cam, len(emb), dim)
+        for key, data in parts.items():
+            fid[key][start:stop] = data
+        self._advance(cam, stop, keys)
+
+    def write_batch(self, header, emb, keys=None):
+        """Writes ``[header, emb]`` rows, scattered to cameras by ``header[:, 0]``."""
+        header, emb = np.asarray(header), np.asarray(emb)
+        if not len(header):
+            return
+        # quantized codecs are applied by write(), frame numbers stay exact in float32
+        dtype = np.float32 if self.quantized else self.dtype
+        rows = np.hstack([header.astype(dtype), emb.astype(dtype)])
+        cams = header[:, 0].astype(np.int64)
+        order = np.argsort(cams, kind='stable')
+        unique_cams, starts = np.unique(cams[order], return_index=True)
+        cam_keys = np.split(np.asarray(keys)[order], starts[1:]) if keys is not None else [None] * len(unique_cams)
+        for cam, cam_rows, keys in zip(unique_cams, np.split(rows[order], starts[1:]), cam_keys):
+            self.write(int(cam), cam_rows, keys)
+
+    def _commit(self):
+        if self.manifest is None or not self.pending:
+            return
+        with open(self.manifest, 'a') as fp:
+            fp.writelines(self.pending)
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.pending = []
+
+    def flush(self):
+        for cam, fid in self.fids.items():
+            fid['emb'].attrs['num_rows'] = self.cursor[cam - 1]
+            fid.flush()
+        self._commit()
+
+    def close(self):
+        for cam, fid in self.fids.items():
+            self._resize(fid, self.cursor[cam - 1])
+            fid['emb'].attrs['num_rows'] = self.cursor[cam - 1]
+            fid.close()
+        self.fids = {}
+        self._commit()
+
+
+class AsyncFeatureWriter(object):
+    """Runs the calls of a ``FeatureWriter`` in a background thread.
+
+    Batches are handed over through a bounded queue, so inference keeps going
+    while h5py writes; ``write_batch`` blocks once ``max_queue`` batches are
+    pending. An error raised in the writer thread is re-raised by the next
+    call and by ``close()``.
+    """
+
+    def __init__(self, writer, max_queue=64):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.wait_time = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining so that the producer never blocks on a dead writer
+                continue
+            method, args = item
+            try:
+                getattr(self.writer, method)(*args)
+            except Exception:
+                self.error = traceback.format_exc()
+
+    def _check(self):
+        if self.error is not None:
+            raise RuntimeError('feature writer thread failed:\n{}'.format(self.error))
+
+    def _put(self, method, *args):
+        self._check()
+        tic = time.time()
+        self.queue.put((method, args))
+        self.wait_time += time.time() - tic
+
+    def write(self, cam, rows, keys=None):
+        self._put('write', cam, rows, keys)
+
+    def write_batch(self, header, emb, keys=None):
+        self._put('write_batch', header, emb, keys)
+
+    def flush(self):
+        self._put('flush')
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.writer.close()
+        self._check()
@@ -0,0 +1,61 @@
+from __future__ import print_function, absolute_import
+import argparse
+import json
+import os.path as osp
+import time
+
+import numpy as np
+
+from reid.feature_extraction import FeatureDatabase, IVFIndex
+from reid.feature_extraction.ivf import read_feature_folder, read_database, recall_benchmark
+
+
+def main(args):
+    tic = time.time()
+    if args.database:
+        with FeatureDatabase(osp.expanduser(args.database), 'r') as database:
+            keys, emb = read_database(database)
+        header = None
+    else:
+        header, emb = read_feature_folder(osp.expanduser(args.features), args.num_header)
+    print('{} x {} embeddings loaded in {:.1f}s'.format(emb.shape[0], emb.shape[1], time.time() - tic))
+
+    tic = time.time()
+    index = IVFIndex(args.num_lists, args.num_subspaces).train(emb, args.num_iter).add(emb)
+    print('index built in {:.1f}s'.format(time.time() - tic))
+    output = osp.expanduser(args.output)
+    index.save(output)
+    # ids are the rows of the stacked embeddings, map them back to (cam, frame) or to the database keys
+    if header is not None:
+        np.save(osp.join(output, 'header.npy'), header)
+    else:
+        with open(osp.join(output, 'keys.txt'), 'w') as fp:
+            fp.writelines('{}\n'.format(key) for key in keys)
+    print('saved to {}'.format(output))
+
+    if args.benchmark:
+        rng = np.random.RandomState(args.seed)
+        queries = emb[rng.choice(len(emb), min(args.num_queries, len(emb)), replace=False)]
+        results = recall_benchmark(IVFIndex.load(output), emb, queries, args.k, args.nprobe)
+        with open(osp.join(output, 'benchmark.json'), 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IVF / IVF-PQ index over stored embeddings")
+    parser.add_argument('--features', type=str, default='',
+                        help="folder of features<cam>.h5 files, e.g. det_features_<l0_name>_<det_time>")
+    parser.add_argument('--num_header', type=int, default=2, help="2 for detections, 3 for ground truth")
+    parser.add_argument('--database', type=str, default='', help="FeatureDatabase h5 file instead of --features")
+    parser.add_argument('--output', type=str, required=True)
+    parser.add_argument('--num_lists', type=int, default=1024)
+    parser.add_argument('--num_subspaces', type=int, default=0, help="PQ sub-vectors, 0 keeps float32 vectors")
+    parser.add_argument('--num_iter', type=int, default=20, help="k-means iterations")
+    parser.add_argument('--benchmark', action='store_true', help="recall@k and latency against exact search")
+    parser.add_argument('--num_queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64])
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    assert args.features or args.database, "--features or --database is required"
+    main(args)
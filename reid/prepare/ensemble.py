@@ -1,5 +1,4 @@
 import numpy as np
-import h5py
 import os
 import os.path as osp
 from glob import glob
@@ -7,7 +6,12 @@ import re
 from collections import defaultdict
 from sklearn.preprocessing import normalize
 
+from reid.feature_extraction import load_features, FeatureWriter
+from reid.feature_extraction.codec import codec_error
+
 models = ['lr001', 'lr001_softmargin', 'lr001_colorjitter']
+# storage of the ensemble: 'float64', 'float32', 'float16' or 'int8' (per-row scale)
+codec = 'float64'
 dirs = ['gt_all']  # 'gt_mini', 'test', 'trainval',
 
 for data_dir in dirs:
@@ -26,8 +30,7 @@ for data_dir in dirs:
 
         pattern = re.compile(r'(\d+)')
         for fname in fnames:
-            h5file = h5py.File(fname, 'r')
-            data = np.array(h5file['emb'])
+            data = load_features(fname)
             cam = int(pattern.search(osp.basename(fname)).groups()[0])
             if cam not in models_feat:
                 models_feat[cam] = np.array([])
@@ -48,11 +51,14 @@ for data_dir in dirs:
             folder = osp.join('/home/houyz/Data/AIC19/L0-features',
                               'det_features_zju_lr001_ensemble_{}_ssd'.format(data_dir))
 
-        output_fname = folder + '/features%d.h5' % cam
         if not osp.exists(folder):
             os.makedirs(folder)
-        with h5py.File(output_fname, 'w') as f:
-            f.create_dataset('emb', data=ensemble_feat, dtype=float, maxshape=(None, None))
-            pass
+        num_rows = np.zeros(cam, dtype=np.int64)
+        num_rows[cam - 1] = len(ensemble_feat)
+        with FeatureWriter(folder, num_rows, dtype=codec, num_header=models_header[cam].shape[1]) as writer:
+            writer.write(cam, ensemble_feat)
+        error = codec_error(models_feat[cam], codec)
+        print('cam {}: {} rows as {}, max abs err {:.2e}, rel l2 err {:.2e}, min cos {:.6f}'
+              .format(cam, len(ensemble_feat), codec, error['max_abs'], error['rel_l2'], error['min_cos']))
 
     pass
@@ -10,26 +10,8 @@ path = '~/Data/AIC19/'
 og_fps = 10
 
 
-def get_bbox(type='gt', det_time='train', fps=10, det_type='ssd'):
-    # type = ['gt','det','labeled']
+def get_scenes(type='gt', det_time='train'):
     data_path = osp.join(osp.expanduser(path), 'test' if det_time == 'test' else 'train')
-    save_path = osp.join(osp.expanduser('~/Data/AIC19/ALL_{}_bbox/'.format(type)), det_time)
-
-    if type == 'gt' or type == 'labeled':
-        save_path = osp.join(save_path, 'gt_bbox_{}_fps'.format(fps))
-        fps_pooling = int(og_fps / fps)  # use minimal number of gt's to train ide model
-    else:
-        save_path = osp.join(save_path, det_type)
-
-    if not osp.exists(save_path):  # mkdir
-        if not osp.exists(osp.dirname(save_path)):
-            if not osp.exists(osp.dirname(osp.dirname(save_path))):
-                # if not osp.exists(osp.dirname(osp.dirname(osp.dirname(save_path)))):
-                #     os.mkdir(osp.dirname(osp.dirname(osp.dirname(save_path))))
-                os.mkdir(osp.dirname(osp.dirname(save_path)))
-            os.mkdir(osp.dirname(save_path))
-        os.mkdir(save_path)
-
     # scene selection for train/val
     if det_time == 'train':
         scenes = ['S03', 'S04']
@@ -41,10 +23,16 @@ def get_bbox(type='gt', det_time='train', fps=10, det_type='ssd'):
         scenes = ['S02', 'S06']
     else:  # test
         scenes = os.listdir(data_path)
+    return data_path, scenes
+
 
+def get_cameras(type='gt', det_time='train', det_type='ssd'):
+    """Returns ``(iCam, video_file, bbox_filename, delimiter)`` of every camera of the split."""
+    data_path, scenes = get_scenes(type, det_time)
+    cameras = []
     for scene in scenes:
         scene_path = osp.join(data_path, scene)
-        for camera_dir in os.listdir(scene_path):
+        for camera_dir in sorted(os.listdir(scene_path)):
             iCam = int(camera_dir[1:])
             # get bboxs
             if type == 'gt':
@@ -63,67 +51,101 @@ def get_bbox(type='gt', det_time='train', fps=10, det_type='ssd'):
                 bbox_filename = osp.join(scene_path, camera_dir, 'det',
                                          'det_{}.txt'.format('ssd512' if det_type == 'ssd' else 'yolo3'))
                 delimiter = ','
-            bboxs = np.loadtxt(bbox_filename, delimiter=delimiter)
-            if type == 'gt' or type == 'labeled':
-                bboxs = bboxs[np.where(bboxs[:, 0] % fps_pooling == 0)[0], :]
-
-            # get frame_pics
-            video_file = osp.join(scene_path, camera_dir, 'vdo.avi')
-            video_reader = cv2.VideoCapture(video_file)
-            # get vcap property
-            width = video_reader.get(cv2.CAP_PROP_FRAME_WIDTH)  # float
-            height = video_reader.get(cv2.CAP_PROP_FRAME_HEIGHT)  # float
-
-            # enlarge by 40 pixel for detection
-            if type == 'det' or type == 'labeled':
-                bboxs[:, 2:4] = bboxs[:, 2:4] - 20
-                bboxs[:, 4:6] = bboxs[:, 4:6] + 40
-
-            # bboxs
-            bbox_top = np.maximum(bboxs[:, 3], 0)
-            bbox_bottom = np.minimum(bboxs[:, 3] + bboxs[:, 5], height - 1)
-            bbox_left = np.maximum(bboxs[:, 2], 0)
-            bbox_right = np.minimum(bboxs[:, 2] + bboxs[:, 4], width - 1)
-            bboxs[:, 2:6] = np.stack((bbox_top, bbox_bottom, bbox_left, bbox_right), axis=1)
-
-            # frame_pics = []
-            frame_num = 0
-            success = video_reader.isOpened()
-            printed_img_count = 0
-            while (success):
-                assert psutil.virtual_memory().percent < 95, "reading video will be killed!!!!!!"
-
-                success, frame_pic = video_reader.read()
-                frame_num = frame_num + 1
-                bboxs_in_frame = bboxs[bboxs[:, 0] == frame_num, :]
-
-                for index in range(bboxs_in_frame.shape[0]):
-                    frame = int(bboxs_in_frame[index, 0])
-                    pid = int(bboxs_in_frame[index, 1])
-                    bbox_top = int(bboxs_in_frame[index, 2])
-                    bbox_bottom = int(bboxs_in_frame[index, 3])
-                    bbox_left = int(bboxs_in_frame[index, 4])
-                    bbox_right = int(bboxs_in_frame[index, 5])
-
-                    bbox_pic = frame_pic[bbox_top:bbox_bottom, bbox_left:bbox_right]
-                    if bbox_pic.size == 0:
-                        continue
-
-                    if type == 'gt' or type == 'labeled':
-                        save_file = osp.join(save_path, "{:04d}_c{:02d}_f{:05d}.jpg".format(pid, iCam, frame))
-                    else:
-                        save_file = osp.join(save_path, 'c{:02d}_f{:05d}_{:03d}.jpg'.format(iCam, frame, index))
-
-                    cv2.imwrite(save_file, bbox_pic)
-                    cv2.waitKey(0)
-                    printed_img_count += 1
-
-                cv2.waitKey(0)
-            video_reader.release()
-            # assert printed_img_count == bboxs.shape[0]
-
-            print(video_file, 'completed!')
-        print(scene, 'completed!')
+            cameras.append((iCam, osp.join(scene_path, camera_dir, 'vdo.avi'), bbox_filename, delimiter))
+    return cameras
+
+
+def read_bboxs(bbox_filename, delimiter, width, height, type='gt', fps=10):
+    """Returns bboxs as ``[frame, pid, top, bottom, left, right]`` clipped to the frame, sorted by frame."""
+    bboxs = np.loadtxt(bbox_filename, delimiter=delimiter, ndmin=2)
+    if type == 'gt' or type == 'labeled':
+        fps_pooling = int(og_fps / fps)  # use minimal number of gt's to train ide model
+        bboxs = bboxs[np.where(bboxs[:, 0] % fps_pooling == 0)[0], :]
+
+    # enlarge by 40 pixel for detection
+    if type == 'det' or type == 'labeled':
+        bboxs[:, 2:4] = bboxs[:, 2:4] - 20
+        bboxs[:, 4:6] = bboxs[:, 4:6] + 40
+
+    # bboxs
+    bbox_top = np.maximum(bboxs[:, 3], 0)
+    bbox_bottom = np.minimum(bboxs[:, 3] + bboxs[:, 5], height - 1)
+    bbox_left = np.maximum(bboxs[:, 2], 0)
+    bbox_right = np.minimum(bboxs[:, 2] + bboxs[:, 4], width - 1)
+    bboxs[:, 2:6] = np.stack((bbox_top, bbox_bottom, bbox_left, bbox_right), axis=1)
+    # stable, so bboxs keep their order (and index) within a frame
+    return bboxs[np.argsort(bboxs[:, 0], kind='stable'), :6]
+
+
+def iter_crops(video_reader, bboxs):
+    """Yields ``(frame, pid, index, crop)`` for every non-empty bbox, crops are BGR views of the frame.
+
+    ``index`` is the position of the bbox within its frame, frames are numbered from 1.
+    Frames without bboxs are skipped without being decoded.
+    """
+    frames = bboxs[:, 0].astype(np.int64)
+    frame_num = 0
+    while video_reader.isOpened() and len(frames) and frame_num < frames[-1]:
+        if not video_reader.grab():
+            break
+        frame_num = frame_num + 1
+        start, stop = np.searchsorted(frames, [frame_num, frame_num + 1])
+        if start == stop:
+            continue
+        success, frame_pic = video_reader.retrieve()
+        if not success:
+            break
+        for index in range(stop - start):
+            pid = int(bboxs[start + index, 1])
+            bbox_top, bbox_bottom, bbox_left, bbox_right = bboxs[start + index, 2:6].astype(int)
+            bbox_pic = frame_pic[bbox_top:bbox_bottom, bbox_left:bbox_right]
+            if bbox_pic.size == 0:
+                continue
+            yield frame_num, pid, index, bbox_pic
+
+
+def get_crop_name(type, iCam, frame, pid, index):
+    if type == 'gt' or type == 'labeled':
+        return "{:04d}_c{:02d}_f{:05d}.jpg".format(pid, iCam, frame)
+    return 'c{:02d}_f{:05d}_{:03d}.jpg'.format(iCam, frame, index)
+
+
+def get_bbox(type='gt', det_time='train', fps=10, det_type='ssd'):
+    # type = ['gt','det','labeled']
+    save_path = osp.join(osp.expanduser('~/Data/AIC19/ALL_{}_bbox/'.format(type)), det_time)
+
+    if type == 'gt' or type == 'labeled':
+        save_path = osp.join(save_path, 'gt_bbox_{}_fps'.format(fps))
+    else:
+        save_path = osp.join(save_path, det_type)
+
+    if not osp.exists(save_path):  # mkdir
+        if not osp.exists(osp.dirname(save_path)):
+            if not osp.exists(osp.dirname(osp.dirname(save_path))):
+                # if not osp.exists(osp.dirname(osp.dirname(osp.dirname(save_path)))):
+                #     os.mkdir(osp.dirname(osp.dirname(osp.dirname(save_path))))
+                os.mkdir(osp.dirname(osp.dirname(save_path)))
+            os.mkdir(osp.dirname(save_path))
+        os.mkdir(save_path)
+
+    for iCam, video_file, bbox_filename, delimiter in get_cameras(type, det_time, det_type):
+        # get frame_pics
+        video_reader = cv2.VideoCapture(video_file)
+        # get vcap property
+        width = video_reader.get(cv2.CAP_PROP_FRAME_WIDTH)  # float
+        height = video_reader.get(cv2.CAP_PROP_FRAME_HEIGHT)  # float
+        bboxs = read_bboxs(bbox_filename, delimiter, width, height, type, fps)
+
+        printed_img_count = 0
+        for frame, pid, index, bbox_pic in iter_crops(video_reader, bboxs):
+            assert psutil.virtual_memory().percent < 95, "reading video will be killed!!!!!!"
+            save_file = osp.join(save_path, get_crop_name(type, iCam, frame, pid, index))
+            cv2.imwrite(save_file, bbox_pic)
+            printed_img_count += 1
+        video_reader.release()
+        # assert printed_img_count == bboxs.shape[0]
+
+        print(video_file, 'completed!')
     print(save_path, 'complete d!')
 
 
@@ -0,0 +1,37 @@
+from __future__ import print_function, absolute_import
+import argparse
+import os.path as osp
+import time
+
+from reid import datasets
+from reid.utils.data.packed import pack_images
+from reid.utils.my_utils import get_dataset
+
+
+def main(args):
+    dataset = get_dataset(args.dataset, osp.expanduser(args.data_dir), args.combine_trainval, args.tracking_icams,
+                          args.tracking_fps)
+    output = osp.expanduser(args.output)
+    for split in args.splits:
+        tic = time.time()
+        # (pid, cam, frame) from the file names where the dataset parses them
+        num = pack_images(getattr(dataset, split), getattr(dataset, split + '_path'), osp.join(output, split + '.u8'),
+                          args.height, args.width, info=getattr(dataset, split + '_info', None),
+                          batch_size=args.batch_size, num_workers=args.num_workers)
+        print('{}: {} crops packed at {}x{} in {:.1f}s'.format(split, num, args.height, args.width, time.time() - tic))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pack the crops of a dataset into one memory-mappable file per split")
+    parser.add_argument('-d', '--dataset', type=str, default='market1501', choices=datasets.names())
+    parser.add_argument('--data-dir', type=str, metavar='PATH', default='data')
+    parser.add_argument('--combine-trainval', action='store_true')
+    parser.add_argument('--tracking_icams', type=int, default=0)
+    parser.add_argument('--tracking_fps', type=int, default=1)
+    parser.add_argument('--height', type=int, default=256, help="same as the --height of training")
+    parser.add_argument('--width', type=int, default=128, help="same as the --width of training")
+    parser.add_argument('--splits', type=str, nargs='+', default=['train', 'query', 'gallery'])
+    parser.add_argument('-b', '--batch-size', type=int, default=256)
+    parser.add_argument('-j', '--num-workers', type=int, default=4)
+    parser.add_argument('--output', type=str, required=True, metavar='PATH', help="pass it as --packed to training")
+    main(parser.parse_args())
@@ -0,0 +1,72 @@
+from __future__ import print_function, absolute_import
+import argparse
+import os.path as osp
+import time
+
+import numpy as np
+import torch
+
+from reid.evaluation_metrics import topk, k_reciprocal_rerank, query_expansion
+from reid.evaluation_metrics.rerank import rerank_report
+from reid.evaluators import pairwise_distance
+from reid.feature_extraction import load_features, read_manifest
+
+
+def load_reid_test(folder):
+    # save_cnn_feature.py --type reid_test: every image in features1.h5, [cam, pid, frame] header
+    features = load_features(osp.join(folder, 'features1.h5'))[:, 3:]
+    fnames = read_manifest(osp.join(folder, 'manifest.txt'))[1]
+    ids = np.array([int(osp.splitext(fname)[0]) for fname in fnames])
+    order = np.argsort(ids)
+    return features[order].astype(np.float32), ids[order]
+
+
+def main(args):
+    query_features, _ = load_reid_test(args.query_dir or osp.join(
+        osp.expanduser(args.features_dir), 'aic_reid_query_features_{}'.format(args.l0_name)))
+    gallery_features, gallery_ids = load_reid_test(args.gallery_dir or osp.join(
+        osp.expanduser(args.features_dir), 'aic_reid_gallery_features_{}'.format(args.l0_name)))
+    print('{} queries, {} gallery images'.format(len(query_features), len(gallery_features)))
+
+    if args.qe_k:
+        query_features, gallery_features = [features.numpy() for features in query_expansion(
+            query_features, gallery_features, args.qe_k, args.qe_alpha, args.dba)]
+    if args.report:
+        rerank_report(query_features, gallery_features, args.k1, args.k2, args.lambda_value, args.block_size)
+    tic = time.time()
+    if args.rerank:
+        distmat = k_reciprocal_rerank(query_features, gallery_features, args.k1, args.k2, args.lambda_value,
+                                      args.block_size)
+    else:
+        distmat = pairwise_distance(torch.from_numpy(query_features), torch.from_numpy(gallery_features)).numpy()
+    index = topk(distmat, min(args.topk, len(gallery_ids)))
+    print('ranking takes {:.2f}s'.format(time.time() - tic))
+
+    # one line per query, in query id order: the ids of the closest gallery images
+    with open(args.output, 'w') as fp:
+        for row in gallery_ids[index]:
+            fp.write(' '.join(map(str, row)) + '\n')
+    print('wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="AIC19 track 2 submission from reid_test features")
+    parser.add_argument('--l0_name', type=str, default='zju_lr001_ensemble')
+    parser.add_argument('--features_dir', type=str, default='~/Data/AIC19-reid/L0-features')
+    parser.add_argument('--query_dir', type=str, default='',
+                        help="default: <features_dir>/aic_reid_query_features_<l0_name>")
+    parser.add_argument('--gallery_dir', type=str, default='',
+                        help="default: <features_dir>/aic_reid_gallery_features_<l0_name>")
+    parser.add_argument('--qe_k', type=int, default=0, help="neighbours of alpha query expansion, 0 disables it")
+    parser.add_argument('--qe_alpha', type=float, default=3.)
+    parser.add_argument('--dba', action='store_true', help="database-side augmentation before query expansion")
+    parser.add_argument('--rerank', action='store_true', help="k-reciprocal re-ranking")
+    parser.add_argument('--k1', type=int, default=20)
+    parser.add_argument('--k2', type=int, default=6)
+    parser.add_argument('--lambda_value', type=float, default=0.3)
+    parser.add_argument('--block_size', type=int, default=0, help="rows per re-ranking distance block, 0: automatic")
+    parser.add_argument('--report', action='store_true',
+                        help="compare time and peak memory of the blocked and the dense re-ranking")
+    parser.add_argument('--topk', type=int, default=100)
+    parser.add_argument('--output', type=str, default='track2.txt')
+    main(parser.parse_args())
@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+class BatchAugmentation(object):
+    """collate_fn applying the training augmentation to a whole batch.
+
+    The samples are uint8 ``[3, H, W]`` tensors (``ToUint8Tensor`` after the
+    resize). The batch gets, with the same distributions as the per-sample
+    ``RandomHorizontalFlip, Pad(padding), RandomCrop, ToTensor, Normalize,
+    RandomErasing(erasing)`` of ``get_data``: a flip with probability 0.5,
+    a crop at a uniform offset of the zero-padded image, the normalization,
+    and with probability ``erasing`` one rectangle set to ``erasing_mean``,
+    found by the same 100 rejection sampling attempts. The random
+    parameters are drawn for the whole batch at once; flip and normalization
+    are whole-batch tensor operations, the crop and the erasing one slice
+    copy per sample.
+    """
+
+    def __init__(self, padding=10, flip=True, erasing=0., mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225),
+                 sl=0.02, sh=0.4, r1=0.3, erasing_mean=(0.4914, 0.4822, 0.4465), attempts=100):
+        self.padding = padding
+        self.flip = flip
+        self.erasing = erasing
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.sl = sl
+        self.sh = sh
+        self.r1 = r1
+        self.erasing_mean = torch.tensor(erasing_mean).view(1, 3, 1, 1)
+        self.attempts = attempts
+
+    def __call__(self, batch):
+        batch = default_collate(batch)
+        return [self.augment(batch[0])] + list(batch[1:])
+
+    def augment(self, imgs):
+        num, _, height, width = imgs.size()
+        imgs = imgs.clone()
+        if self.flip:
+            flipped = torch.nonzero(torch.rand(num) < 0.5).view(-1)
+            imgs[flipped] = imgs[flipped].flip(3)
+        if self.padding > 0:
+            imgs = self._pad_crop(imgs)
+        # ToTensor and Normalize as one scale and shift per channel
+        imgs = imgs.float().mul_(1 / (255 * self.std)).add_(-self.mean / self.std)
+        if self.erasing > 0:
+            for index, x1, y1, h, w in self._erasing_params(num, height, width):
+                imgs[index, :, x1:x1 + h, y1:y1 + w] = self.erasing_mean[0]
+        return imgs
+
+    def _pad_crop(self, imgs):
+        # a crop of the zero-padded image at offsets in [0, 2 * padding], as
+        # RandomCrop after Pad, is the image shifted by offset - padding
+        num, _, height, width = imgs.size()
+        shifts = (torch.randint(0, 2 * self.padding + 1, (num, 2)) - self.padding).tolist()
+        out = torch.zeros_like(imgs)
+        for index, (dy, dx) in enumerate(shifts):
+            out[index, :, max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)] = \
+                imgs[index, :, max(0, dy):height + min(0, dy), max(0, dx):width + min(0, dx)]
+        return out
+
+    def _erasing_params(self, num, height, width):
+        area = height * width
+        # all attempts of all samples at once, the first fitting one is used
+        target_area = (torch.rand(num, self.attempts, dtype=torch.float64) * (self.sh - self.sl) + self.sl) * area
+        aspect_ratio = torch.rand(num, self.attempts, dtype=torch.float64) * (1 / self.r1 - self.r1) + self.r1
+        h = torch.round(torch.sqrt(target_area * aspect_ratio)).long()
+        w = torch.round(torch.sqrt(target_area / aspect_ratio)).long()
+        fits = (w < width) & (h < height)
+        # mask of the first fitting attempt, all false if none fits
+        first = ((fits.long().cumsum(1) == 1) & fits).long()
+        h = (h * first).sum(1)
+        w = (w * first).sum(1)
+        # randint(0, height - h) and randint(0, width - w), both ends included
+        x1 = (torch.rand(num, dtype=torch.float64) * (height - h + 1).double()).long()
+        y1 = (torch.rand(num, dtype=torch.float64) * (width - w + 1).double()).long()
+        erased = torch.nonzero((torch.rand(num) < self.erasing) & fits.any(1)).view(-1)
+        return zip(erased.tolist(), x1[erased].tolist(), y1[erased].tolist(), h[erased].tolist(), w[erased].tolist())
@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+import mmap
+import multiprocessing
+
+import numpy as np
+
+
+def _shared_array(shape, dtype):
+    # anonymous shared mapping: pages are allocated on first write and the
+    # DataLoader workers forked afterwards see and modify the same memory
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return np.frombuffer(mmap.mmap(-1, max(nbytes, 1)), dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+class SharedImageCache(object):
+    """Decoded uint8 ``[H, W, 3]`` images keyed by dataset index, shared by
+    the DataLoader workers.
+
+    The images are kept in one shared-memory arena of ``budget`` bytes cut
+    into segments of ``segment_bytes``; new images are appended to the
+    current segment. When no segment is free, CLOCK eviction over the
+    segments drops the first one that had no hit since the hand last passed
+    it, with all its images. Images larger than a segment are not cached.
+
+    The memory is shared by forking (the default start method on Linux), so
+    the cache is created in the main process before the workers start and
+    lives across epochs. Hit, miss and eviction counters are shared too.
+    """
+
+    def __init__(self, num_items, budget, segment_bytes=4 << 20):
+        self.segment_bytes = max(int(min(segment_bytes, budget)), 1)
+        self.num_segments = int(budget // self.segment_bytes)
+        self.arena = _shared_array([self.num_segments * self.segment_bytes], np.uint8)
+        # arena offset of every item, -1 if not cached, and its height and width
+        self.offsets = _shared_array([num_items], np.int64)
+        self.offsets[:] = -1
+        self.shapes = _shared_array([num_items, 2], np.int32)
+        self.fill = _shared_array([self.num_segments], np.int64)
+        self.referenced = _shared_array([self.num_segments], np.uint8)
+        # current segment, clock hand, hits, misses, evicted images
+        self.state = _shared_array([5], np.int64)
+        self.lock = multiprocessing.Lock()
+
+    def __len__(self):
+        return int((self.offsets >= 0).sum())
+
+    def get(self, index):
+        with self.lock:
+            offset = self.offsets[index]
+            if offset < 0:
+                self.state[3] += 1
+                return None
+            height, width = self.shapes[index]
+            # copied under the lock, the segment may be evicted right after
+            img = self.arena[offset:offset + height * width * 3].copy()
+            self.referenced[offset // self.segment_bytes] = 1
+            self.state[2] += 1
+        return img.reshape(height, width, 3)
+
+    def put(self, index, img):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if img.nbytes > self.segment_bytes or self.num_segments == 0:
+            return
+        with self.lock:
+            if self.offsets[index] >= 0:
+                # cached meanwhile by another worker
+                return
+            segment = self._allocate(img.nbytes)
+            offset = segment * self.segment_bytes + self.fill[segment]
+            self.arena[offset:offset + img.nbytes] = img.reshape(-1)
+            self.fill[segment] += img.nbytes
+            self.shapes[index] = img.shape[:2]
+            self.offsets[index] = offset
+
+    def _allocate(self, nbytes):
+        current = self.state[0]
+        if self.fill[current] + nbytes <= self.segment_bytes:
+            return current
+        empty = np.flatnonzero(self.fill == 0)
+        if len(empty):
+            segment = empty[0]
+        else:
+            hand = self.state[1]
+            # the current segment is only evicted when it is the only one
+            while (hand == current and self.num_segments > 1) or self.referenced[hand]:
+                self.referenced[hand] = 0
+                hand = (hand + 1) % self.num_segments
+            segment = hand
+            self.state[1] = (hand + 1) % self.num_segments
+            start = segment * self.segment_bytes
+            evicted = (self.offsets >= start) & (self.offsets < start + self.segment_bytes)
+            self.offsets[evicted] = -1
+            self.state[4] += evicted.sum()
+            self.fill[segment] = 0
+        self.referenced[segment] = 0
+        self.state[0] = segment
+        return segment
+
+    def stats(self):
+        with self.lock:
+            hits, misses, evictions = self.state[2:5].tolist()
+            used = int(self.fill.sum())
+        return {'hits': hits, 'misses': misses, 'evictions': evictions,
+                'hit_rate': hits / float(max(hits + misses, 1)), 'images': len(self),
+                'bytes': used, 'budget': self.num_segments * self.segment_bytes}
+
+    def summary(self):
+        stats = self.stats()
+        return 'image cache: {} images, {:.2f}/{:.2f} GB, hit rate {:.1%}, {} evicted'.format(
+            stats['images'], stats['bytes'] / 2. ** 30, stats['budget'] / 2. ** 30, stats['hit_rate'],
+            stats['evictions'])
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+import os
+import os.path as osp
+
+import numpy as np
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from . import transforms as T
+from .preprocessor import Preprocessor
+from ..osutils import mkdir_if_missing
+
+
+class _ToArray(object):
+    def __call__(self, img):
+        return np.array(img, dtype=np.uint8)
+
+
+def pack_images(dataset, root, fpath, height, width, info=None, batch_size=256, num_workers=4):
+    """Decodes the ``(fname, pid, camid)`` images of ``dataset``, resizes them
+    to ``height x width`` as ``T.Resize`` does and writes them to ``fpath``, a
+    raw uint8 ``[N, height, width, 3]`` file, with the index ``fpath + '.npz'``
+    (fnames, pids, camids and the ``[N, 3]`` info, ``(pid, cam, frame)``).
+
+    The info camera is 1-based, as in the ``_info`` of the datasets and the
+    headers of ``save_cnn_feature.py``; it defaults to ``(pid, camid + 1, -1)``
+    of the dataset tuples, whose ``camid`` is 0-based.
+    """
+    mkdir_if_missing(osp.dirname(osp.abspath(fpath)))
+    num = len(dataset)
+    if info is None:
+        info = np.array([(pid, camid + 1, -1) for _, pid, camid in dataset], dtype=np.int64).reshape(-1, 3)
+    # written under a temporary name, a crash never leaves a pack that looks complete
+    images = np.memmap(fpath + '.tmp', dtype=np.uint8, mode='w+', shape=(max(num, 1), height, width, 3))
+    loader = DataLoader(Preprocessor(dataset, root=root, transform=T.Compose([T.Resize((height, width)), _ToArray()])),
+                        batch_size=batch_size, num_workers=num_workers, shuffle=False)
+    start = 0
+    for imgs, _, _, _ in loader:
+        images[start:start + len(imgs)] = imgs.numpy()
+        start += len(imgs)
+    images.flush()
+    del images
+    with open(fpath + '.npz.tmp', 'wb') as fp:
+        np.savez(fp, fnames=np.array([fname for fname, _, _ in dataset]),
+                 pids=np.array([pid for _, pid, _ in dataset], dtype=np.int64),
+                 camids=np.array([camid for _, _, camid in dataset], dtype=np.int64),
+                 info=np.asarray(info, dtype=np.int64), shape=np.array([num, height, width, 3]))
+    # the index goes into place last, a pack is complete once it has one
+    if osp.exists(fpath + '.npz'):
+        os.remove(fpath + '.npz')
+    os.rename(fpath + '.tmp', fpath)
+    os.rename(fpath + '.npz.tmp', fpath + '.npz')
+    return num
+
+
+class PackedPreprocessor(object):
+    """Drop-in for ``Preprocessor`` reading a file written by ``pack_images``.
+
+    The file is memory-mapped on first access in every (worker) process, a
+    sample is one slice of it instead of a JPEG open and decode. Images are
+    returned as PIL images of the packed size, so the usual transforms apply.
+    With ``with_info``, samples also carry their ``(pid, cam, frame)`` row.
+    """
+
+    def __init__(self, fpath, transform=None, with_info=False):
+        super(PackedPreprocessor, self).__init__()
+        self.fpath = fpath
+        self.transform = transform
+        index = np.load(fpath + '.npz')
+        self.dataset = list(zip(index['fnames'].tolist(), index['pids'].tolist(), index['camids'].tolist()))
+        self.info = index['info'] if with_info else None
+        self.shape = tuple(index['shape'].tolist())
+        num, height, width, channels = self.shape
+        if osp.getsize(fpath) != max(num, 1) * height * width * channels:
+            raise ValueError('{} does not match its index, pack the images again'.format(fpath))
+        self._images = None
+
+    def __getstate__(self):
+        # workers map the file themselves
+        state = self.__dict__.copy()
+        state['_images'] = None
+        return state
+
+    @property
+    def images(self):
+        if self._images is None:
+            num, height, width, channels = self.shape
+            self._images = np.memmap(self.fpath, dtype=np.uint8, mode='r',
+                                     shape=(max(num, 1), height, width, channels))
+        return self._images
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices):
+        if isinstance(indices, (tuple, list)):
+            return [self._get_single_item(index) for index in indices]
+        return self._get_single_item(indices)
+
+    def _get_single_item(self, index):
+        fname, pid, camid = self.dataset[index]
+        img = Image.fromarray(self.images[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.info is not None:
+            return img, fname, pid, camid, self.info[index]
+        return img, fname, pid, camid
@@ -1,15 +1,21 @@
 from __future__ import absolute_import
 import os.path as osp
 
+import numpy as np
 from PIL import Image
 
 
 class Preprocessor(object):
-    def __init__(self, dataset, root=None, transform=None):
+    def __init__(self, dataset, root=None, transform=None, info=None, cache=None):
         super(Preprocessor, self).__init__()
         self.dataset = dataset
         self.root = root
         self.transform = transform
+        # optional integer array aligned with dataset (e.g. dataset.train_info),
+        # returned per sample so that batches carry it as one tensor
+        self.info = info
+        # optional SharedImageCache of the decoded images, before the transform
+        self.cache = cache
 
     def __len__(self):
         return len(self.dataset)
@@ -24,7 +30,17 @@ class Preprocessor(object):
         fpath = fname
         if self.root is not None:
             fpath = osp.join(self.root, fname)
-        img = Image.open(fpath).convert('RGB')
+        img = None
+        if self.cache is not None:
+            img = self.cache.get(index)
+            if img is not None:
+                img = Image.fromarray(img)
+        if img is None:
+            img = Image.open(fpath).convert('RGB')
+            if self.cache is not None:
+                self.cache.put(index, np.asarray(img))
         if self.transform is not None:
             img = self.transform(img)
+        if self.info is not None:
+            return img, fname, pid, camid, self.info[index]
         return img, fname, pid, camid
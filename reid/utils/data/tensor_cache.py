@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+import hashlib
+import os.path as osp
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from . import transforms as T
+from .preprocessor import Preprocessor
+from ..osutils import mkdir_if_missing
+
+
+class ToUint8Tensor(object):
+    """PIL image to a ``[3, H, W]`` uint8 tensor, ToTensor without the scaling."""
+
+    def __call__(self, img):
+        return torch.from_numpy(np.asarray(img, dtype=np.uint8).transpose(2, 0, 1).copy())
+
+
+class CachedTensorLoader(object):
+    """Test set loader that decodes and resizes every image only once.
+
+    The first pass reads the images through a DataLoader and keeps them as
+    uint8 ``[N, 3, height, width]`` tensors, in RAM or, with ``cache_dir``, in
+    a memory-mapped file that later runs reuse. Every pass yields
+    ``(imgs, fnames, pids, camids)`` batches equal to those of a Preprocessor
+    with ``Resize((height, width)), ToTensor(), Normalize(mean, std)``; the
+    normalization is done per batch on the cached tensors.
+    """
+
+    def __init__(self, dataset, root, height, width, batch_size=64, num_workers=4,
+                 mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225), cache_dir=None):
+        self.dataset = dataset
+        self.root = root
+        self.height = height
+        self.width = width
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.fnames = [fname for fname, _, _ in dataset]
+        self.pids = torch.tensor([pid for _, pid, _ in dataset])
+        self.camids = torch.tensor([camid for _, _, camid in dataset])
+        self.images = None
+        self.fpath = None
+        if cache_dir is not None:
+            # one file per image list and size, so a changed dataset is decoded again
+            key = hashlib.md5('\n'.join([str(root)] + self.fnames).encode()).hexdigest()[:16]
+            mkdir_if_missing(cache_dir)
+            self.fpath = osp.join(cache_dir, '{}_{}x{}_{}.u8'.format(key, height, width, len(dataset)))
+            if osp.isfile(self.fpath + '.done'):
+                # copy-on-write, the file itself is never modified
+                self.images = torch.from_numpy(np.memmap(self.fpath, dtype=np.uint8, mode='c',
+                                                         shape=(len(dataset), 3, height, width)))
+
+    def __len__(self):
+        return int(np.ceil(len(self.dataset) / float(self.batch_size)))
+
+    def _normalize(self, imgs):
+        return (imgs.float().div_(255) - self.mean) / self.std
+
+    def _fill(self):
+        # first pass: decode, resize and cache, while yielding the batches
+        shape = (len(self.dataset), 3, self.height, self.width)
+        if self.fpath is not None:
+            array = np.memmap(self.fpath, dtype=np.uint8, mode='w+', shape=shape)
+            images = torch.from_numpy(array)
+        else:
+            images = torch.empty(shape, dtype=torch.uint8)
+        loader = DataLoader(Preprocessor(self.dataset, root=self.root,
+                                         transform=T.Compose([T.Resize((self.height, self.width)),
+                                                              ToUint8Tensor()])),
+                            batch_size=self.batch_size, num_workers=self.num_workers, shuffle=False)
+        start = 0
+        for imgs, fnames, pids, camids in loader:
+            images[start:start + len(imgs)] = imgs
+            start += len(imgs)
+            yield self._normalize(imgs), fnames, pids, camids
+        if self.fpath is not None:
+            array.flush()
+            open(self.fpath + '.done', 'w').close()
+        self.images = images
+
+    def __iter__(self):
+        if self.images is None:
+            for batch in self._fill():
+                yield batch
+            return
+        for start in range(0, len(self.dataset), self.batch_size):
+            stop = start + self.batch_size
+            yield (self._normalize(self.images[start:stop]), self.fnames[start:stop],
+                   self.pids[start:stop], self.camids[start:stop])
@@ -7,12 +7,17 @@ import matplotlib.pyplot as plt
 
 from torch import nn
 from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
 from reid import datasets
 from reid.utils.serialization import load_checkpoint
 from reid.utils.data.og_sampler import RandomIdentitySampler
 from reid.utils.data.zju_sampler import ZJU_RandomIdentitySampler
 from reid.utils.data import transforms as T
 from reid.utils.data.preprocessor import Preprocessor
+from reid.utils.data.tensor_cache import CachedTensorLoader, ToUint8Tensor
+from reid.utils.data.batch_augment import BatchAugmentation
+from reid.utils.data.packed import PackedPreprocessor
+from reid.utils.data.image_cache import SharedImageCache
 
 
 def draw_curve(path, x_epoch, train_loss, train_prec):
@@ -27,8 +32,7 @@ def draw_curve(path, x_epoch, train_loss, train_prec):
     plt.close(fig)
 
 
-def get_data(name, data_dir, height, width, batch_size, workers,
-             combine_trainval, crop, tracking_icams, fps, re=0, num_instances=0, camstyle=0, zju=0, colorjitter=0):
+def get_dataset(name, data_dir, combine_trainval, tracking_icams, fps):
     root = osp.join(data_dir, name)
     if name == 'duke_tracking':
         if tracking_icams != 0:
@@ -41,6 +45,24 @@ def get_data(name, data_dir, height, width, batch_size, workers,
         dataset = datasets.create(name, root, type='tracking_gt', fps=fps, trainval=combine_trainval)
     else:
         dataset = datasets.create(name, root)
+    return dataset
+
+
+def get_packed(packed, split, items, height, width, transform):
+    # reid/prepare/pack_dataset.py output of this dataset split, checked against the scanned images
+    preprocessor = PackedPreprocessor(osp.join(packed, split + '.u8'), transform=transform)
+    if preprocessor.dataset != items:
+        raise ValueError("{} does not match the {} images, pack the dataset again".format(packed, split))
+    if preprocessor.shape[1:3] != (height, width):
+        raise ValueError("{} is packed at {}x{}, not {}x{}".format(packed, preprocessor.shape[1],
+                                                                   preprocessor.shape[2], height, width))
+    return preprocessor
+
+
+def get_data(name, data_dir, height, width, batch_size, workers,
+             combine_trainval, crop, tracking_icams, fps, re=0, num_instances=0, camstyle=0, zju=0, colorjitter=0,
+             eval_cache=None, packed=None, image_cache=0, batch_augment=False):
+    dataset = get_dataset(name, data_dir, combine_trainval, tracking_icams, fps)
     normalizer = T.Normalize(mean=[0.485, 0.456, 0.406],
                              std=[0.229, 0.224, 0.225])
     num_classes = dataset.num_train_ids
@@ -55,6 +77,18 @@ def get_data(name, data_dir, height, width, batch_size, workers,
         normalizer,
         T.RandomErasing(probability=re),
     ])
+    if batch_augment:
+        # workers only jitter, resize and stack uint8 images, the rest is done per batch in collate
+        sample_transformer = T.Compose([
+            T.ColorJitter(brightness=0.1 * colorjitter, contrast=0.1 * colorjitter, saturation=0.1 * colorjitter,
+                          hue=0),
+            T.Resize((height, width)),
+            ToUint8Tensor(),
+        ])
+        collate_fn = BatchAugmentation(padding=10 * crop, erasing=re)
+    else:
+        sample_transformer = train_transformer
+        collate_fn = default_collate
     test_transformer = T.Compose([
         T.Resize((height, width)),
         # T.RectScale(height, width, interpolation=3),
@@ -62,26 +96,47 @@ def get_data(name, data_dir, height, width, batch_size, workers,
         normalizer,
     ])
 
+    if packed:
+        # pre-resized crops memory-mapped from one file per split, see reid/prepare/pack_dataset.py
+        train_set = get_packed(packed, 'train', dataset.train, height, width, sample_transformer)
+        query_set = get_packed(packed, 'query', dataset.query, height, width, test_transformer)
+        gallery_set = get_packed(packed, 'gallery', dataset.gallery, height, width, test_transformer)
+    else:
+        # decoded training images shared by the workers across epochs, image_cache GB at most
+        train_set = Preprocessor(dataset.train, root=dataset.train_path, transform=sample_transformer,
+                                 cache=SharedImageCache(len(dataset.train), int(image_cache * 2 ** 30))
+                                 if image_cache > 0 else None)
+        query_set = Preprocessor(dataset.query, root=dataset.query_path, transform=test_transformer)
+        gallery_set = Preprocessor(dataset.gallery, root=dataset.gallery_path, transform=test_transformer)
+
     if zju:
         train_loader = DataLoader(
-            Preprocessor(dataset.train, root=dataset.train_path, transform=train_transformer),
-            batch_size=batch_size, num_workers=workers,
+            train_set,
+            batch_size=batch_size, num_workers=workers, collate_fn=collate_fn,
             sampler=ZJU_RandomIdentitySampler(dataset.train, batch_size, num_instances) if num_instances else None,
             shuffle=False if num_instances else True, pin_memory=True, drop_last=False if num_instances else True)
     else:
         train_loader = DataLoader(
-            Preprocessor(dataset.train, root=dataset.train_path, transform=train_transformer),
-            batch_size=batch_size, num_workers=workers,
+            train_set,
+            batch_size=batch_size, num_workers=workers, collate_fn=collate_fn,
             sampler=RandomIdentitySampler(dataset.train, num_instances) if num_instances else None,
             shuffle=False if num_instances else True, pin_memory=True, drop_last=True)
-    query_loader = DataLoader(
-        Preprocessor(dataset.query, root=dataset.query_path, transform=test_transformer),
-        batch_size=batch_size, num_workers=workers,
-        shuffle=False, pin_memory=True)
-    gallery_loader = DataLoader(
-        Preprocessor(dataset.gallery, root=dataset.gallery_path, transform=test_transformer),
-        batch_size=batch_size, num_workers=workers,
-        shuffle=False, pin_memory=True)
+    if eval_cache:
+        # decode and resize the test images once, 'ram' or a folder for memory-mapped files
+        cache_dir = None if eval_cache == 'ram' else eval_cache
+        query_loader = CachedTensorLoader(dataset.query, dataset.query_path, height, width, batch_size, workers,
+                                          cache_dir=cache_dir)
+        gallery_loader = CachedTensorLoader(dataset.gallery, dataset.gallery_path, height, width, batch_size,
+                                            workers, cache_dir=cache_dir)
+    else:
+        query_loader = DataLoader(
+            query_set,
+            batch_size=batch_size, num_workers=workers,
+            shuffle=False, pin_memory=True)
+        gallery_loader = DataLoader(
+            gallery_set,
+            batch_size=batch_size, num_workers=workers,
+            shuffle=False, pin_memory=True)
     if camstyle <= 0:
         camstyle_loader = None
     else:
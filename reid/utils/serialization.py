@@ -31,7 +31,8 @@ def save_checkpoint(state, is_best, fpath='checkpoint.pth.tar'):
 
 def load_checkpoint(fpath):
     if osp.isfile(fpath):
-        checkpoint = torch.load(fpath)
+        # map to cpu, so that gpu checkpoints also load on cpu-only nodes
+        checkpoint = torch.load(fpath, map_location='cpu')
         print("=> Loaded checkpoint '{}'".format(fpath))
         return checkpoint
     else:
@@ -2,18 +2,22 @@ from __future__ import print_function, absolute_import
 
 import argparse
 import json
+import multiprocessing
 import os
-import re
 import time
+from collections import OrderedDict
 
-import h5py
 import numpy as np
 import torch
 from torch.backends import cudnn
+from torch.nn import functional as F
 
 from reid import models
 from reid.datasets import *
-from reid.feature_extraction import extract_cnn_feature
+from reid.feature_extraction import extract_cnn_feature, FeatureWriter, AsyncFeatureWriter, trim_manifests
+from reid.feature_extraction.cnn import get_device, TracedModel
+from reid.feature_extraction.shards import make_shards, claim_shard, mark_done, all_done, claim_merge, merge_shards, \
+    merged, mark_merged, release_merge
 from reid.utils.data import transforms as T
 from reid.utils.data.preprocessor import Preprocessor
 from reid.utils.meters import AverageMeter
@@ -21,108 +25,226 @@ from reid.utils.my_utils import *
 from reid.utils.osutils import mkdir_if_missing
 
 
-def save_file(lines, args, if_created):
-    # write file
+working_dir = osp.dirname(osp.abspath(__file__))
+
+
+def get_folder_name(args, l0_name):
     if args.type == 'detections':
         folder_name = osp.expanduser(
             '~/Data/{}/L0-features/'.format('DukeMTMC' if args.dataset == 'duke' else 'AIC19')) \
-                      + "det_features_{}".format(args.l0_name) + '_' + args.det_time
+                      + "det_features_{}".format(l0_name) + '_' + args.det_time
         if args.dataset == 'aic':
             folder_name += '_{}'.format(args.det_type)
 
     elif args.type == 'gt_mini':
         folder_name = osp.abspath(osp.join(working_dir, os.pardir)) + \
-                      '/DeepCC/experiments/' + args.l0_name + '_' + args.gt_type + '_' + args.det_time
+                      '/DeepCC/experiments/' + l0_name + '_' + args.gt_type + '_' + args.det_time
     elif args.type == 'gt_all':  # only extract ground truth data from 'train' set
         folder_name = osp.expanduser(
             '~/Data/{}/L0-features/'.format('DukeMTMC' if args.dataset == 'duke' else 'AIC19')) \
-                      + "gt_features_{}".format(args.l0_name)
+                      + "gt_features_{}".format(l0_name)
     else:  # reid_test
         folder_name = osp.expanduser('~/Data/AIC19-reid/L0-features/') \
-                      + "aic_reid_{}_features_{}".format(args.reid_test, args.l0_name)
+                      + "aic_reid_{}_features_{}".format(args.reid_test, l0_name)
 
     if args.re:
         folder_name += '_RE'
     if args.crop:
         folder_name += '_CROP'
+    return folder_name
+
+
+def get_outputs(args):
+    # (l0_name, index of the checkpoint) for every output folder, index None for the ensemble
+    outputs = [(l0_name, index) for index, l0_name in enumerate(args.l0_name)]
+    if args.ensemble_name:
+        outputs.append((args.ensemble_name, None))
+    return outputs
 
+
+def get_folders(args, shard=None):
+    folders = [get_folder_name(args, l0_name) for l0_name, _ in get_outputs(args)]
+    if shard is not None:
+        folders = [osp.join(folder, 'shards', shard) for folder in folders]
+    return folders
+
+
+def save_args(args, folder_name):
     mkdir_if_missing(folder_name)
     with open(osp.join(folder_name, 'args.json'), 'w') as fp:
         json.dump(vars(args), fp, indent=1)
-    for cam in range(8 if args.dataset == 'duke' else 40):
-        output_fname = folder_name + '/features%d.h5' % (cam + 1)
-        mkdir_if_missing(os.path.dirname(output_fname))
-        if args.tracking_icams != 0 and cam + 1 != args.tracking_icams:
-            continue
-        if not lines[cam]:
-            continue
 
-        if not if_created[cam]:
-            with h5py.File(output_fname, 'w') as f:
-                mat_data = np.vstack(lines[cam])
-                f.create_dataset('emb', data=mat_data, dtype=float, maxshape=(None, None))
-                pass
-            if_created[cam] = 1
-        else:
-            with h5py.File(output_fname, 'a') as f:
-                mat_data = np.vstack(lines[cam])
-                f['emb'].resize((f['emb'].shape[0] + mat_data.shape[0]), axis=0)
-                f['emb'][-mat_data.shape[0]:] = mat_data
-                pass
 
-    return if_created
+def get_num_rows(args, data_loader):
+    # rows per camera are known before extraction, so every h5 file is allocated once
+    num_cams = 8 if args.dataset == 'duke' else 40
+    if hasattr(data_loader, 'num_rows'):
+        # VideoCropLoader
+        num_rows = data_loader.num_rows
+    else:
+        num_rows = np.bincount(np.array([cam for _, _, cam in data_loader.dataset.dataset], dtype=np.int64),
+                               minlength=num_cams)
+    return np.pad(num_rows, (0, num_cams))[:num_cams]
+
+
+def get_num_header(args):
+    # [cam, frame] for detections, [cam, pid, frame] otherwise
+    return 2 if args.type == 'detections' else 3
+
+
+def create_writer(args, folder_name, num_rows, resume=False):
+    save_args(args, folder_name)
+    writer = FeatureWriter(folder_name, num_rows, dtype=args.feat_dtype, num_header=get_num_header(args),
+                           compression=None if args.compression == 'none' else args.compression,
+                           manifest=osp.join(folder_name, 'manifest.txt'), resume=resume)
+    if args.io_queue:
+        # h5 writes overlap with inference of the next batches
+        writer = AsyncFeatureWriter(writer, max_queue=args.io_queue)
+    return writer
 
 
-def extract_features(model, data_loader, args, is_detection=True, use_fname=True, gt_type='reid'):
-    model.eval()
+def get_loader(args, items, root, info, transformer, folders, resume=False):
+    if resume:
+        # skip the crops that a previous run already committed to all output folders
+        done = trim_manifests([osp.join(folder, 'manifest.txt') for folder in folders])
+        keep = [index for index, (fname, _, _) in enumerate(items) if fname not in done]
+        print('=> {} of {} crops already extracted'.format(len(items) - len(keep), len(items)))
+        items, info = [items[index] for index in keep], info[keep]
+    return DataLoader(Preprocessor(items, root=root, transform=transformer, info=info),
+                      batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False,
+                      pin_memory=args.device != 'cpu' and torch.cuda.is_available())
+
+
+def extract_features(model_s, data_loader, args, folders, resume=False, is_detection=True, use_fname=True):
     print_freq = 1000
     batch_time = AverageMeter()
     data_time = AverageMeter()
+    model_time = AverageMeter()
 
-    if_created = [0 for _ in range(8 if args.dataset == 'duke' else 40)]
-    lines = [[] for _ in range(8 if args.dataset == 'duke' else 40)]
+    outputs = get_outputs(args)
+    num_rows = get_num_rows(args, data_loader)
+    writers = [create_writer(args, folder, num_rows, resume) for folder in folders]
 
+    num_images = 0
     end = time.time()
-    for i, (imgs, fnames, pids, cams) in enumerate(data_loader):
-        cams += 1
-        outputs = extract_cnn_feature(model, imgs, eval_only=True)
-        for fname, output, pid, cam in zip(fnames, outputs, pids, cams):
-            if is_detection:
-                pattern = re.compile(r'c(\d+)_f(\d+)')
-                cam, frame = map(int, pattern.search(fname).groups())
-                # f_names[cam - 1].append(fname)
-                # features[cam - 1].append(output.numpy())
-                line = np.concatenate([np.array([cam, frame]), output.numpy()])
+    for i, (imgs, fnames, pids, cams, info) in enumerate(data_loader):
+        data_time.update(time.time() - end)
+        # every crop is decoded once and fed to all checkpoints
+        tic = time.time()
+        feat_s = [extract_cnn_feature(model, imgs, eval_only=True, flip=args.flip_tta) for model in model_s]
+        model_time.update(time.time() - tic)
+        # info columns: pid, cam, frame as parsed from the file names at dataset load
+        info = info.numpy()
+        if is_detection:
+            header = info[:, [1, 2]]
+        elif use_fname:
+            header = info[:, [1, 0, 2]]
+        else:
+            header = np.stack([cams.numpy() + 1, pids.numpy(), -np.ones(len(pids), dtype=np.int64)], axis=1)
+        keep = np.ones(len(header), dtype=bool)
+        if args.tracking_icams != 0:
+            keep = header[:, 0] == args.tracking_icams
+        header, fnames = header[keep], np.asarray(fnames)[keep]
+        for (l0_name, index), writer in zip(outputs, writers):
+            if index is None:
+                # same as reid/prepare/ensemble.py: concatenate the l2-normalized members, unit norm overall
+                feat = torch.cat([F.normalize(feat, dim=1) for feat in feat_s], dim=1) / len(feat_s) ** 0.5
             else:
-                pattern = re.compile(r'(\d+)_c(\d+)_f(\d+)')
-                if use_fname:
-                    pid, cam, frame = map(int, pattern.search(fname).groups())
-                else:
-                    cam, pid = cam.numpy(), pid.numpy()
-                    frame = -1 * np.ones_like(pid)
-                # line = output.numpy()
-                line = np.concatenate([np.array([cam, pid, frame]), output.numpy()])
-            lines[cam - 1].append(line)
+                feat = feat_s[index]
+            writer.write_batch(header, feat.numpy()[keep], keys=fnames)
         batch_time.update(time.time() - end)
+        num_images += len(imgs)
         end = time.time()
 
         if (i + 1) % print_freq == 0:
             print('Extract Features: [{}/{}]\t'
                   'Time {:.3f} ({:.3f})\t'
                   'Data {:.3f} ({:.3f})\t'
+                  'Model {:.3f} ({:.3f})\t'
                   .format(i + 1, len(data_loader),
                           batch_time.val, batch_time.avg,
-                          data_time.val, data_time.avg))
+                          data_time.val, data_time.avg,
+                          model_time.val, model_time.avg))
+        if (i + 1) % args.commit_freq == 0:
+            # flushed rows are committed to the manifest, --incremental resumes after them
+            for writer in writers:
+                writer.flush()
+
+    for writer in writers:
+        writer.close()
+    # the meters hold seconds per batch, their sums the total seconds of each stage
+    print('Extract Features: {} images\t'
+          'Data {:.1f} img/s\t'
+          'Model {:.1f} img/s\t'
+          'Total {:.1f} img/s\t'
+          .format(num_images,
+                  num_images / max(data_time.sum, 1e-12),
+                  num_images / max(model_time.sum, 1e-12),
+                  num_images / max(batch_time.sum, 1e-12)))
+    if args.io_queue:
+        print('Extract Features: waited {:.2f}s on the feature writers'
+              .format(sum(writer.wait_time for writer in writers)))
+    return
 
-            if_created = save_file(lines, args, if_created)
 
-            lines = [[] for _ in range(8 if args.dataset == 'duke' else 40)]
+def extract_shards(model_s, dataset, args, transformer, rank=0, is_detection=True, use_fname=True):
+    # shards of one camera and consecutive frames, claimed by lock files next to the first output
+    shards = make_shards(dataset.train_info[:, 1], args.shard_size)
+    lock_dir = osp.join(get_folders(args)[0], 'shards')
+    # --reclaim: unfinished shards locked before this run belong to crashed workers, also on other hosts
+    reclaim_before = args.start_time if args.reclaim else None
+    extracted = 0
+    for name, index in shards.items():
+        if not claim_shard(lock_dir, name, reclaim_before):
+            continue
+        print('=> Worker {} extracts shard {} ({} crops)'.format(rank, name, len(index)))
+        folders = get_folders(args, shard=name)
+        # a shard released by a crashed worker continues from its manifests
+        data_loader = get_loader(args, [dataset.train[i] for i in index], dataset.train_path,
+                                 dataset.train_info[index], transformer, folders, resume=True)
+        extract_features(model_s, data_loader, args, folders, resume=True,
+                         is_detection=is_detection, use_fname=use_fname)
+        mark_done(lock_dir, name)
+        extracted += 1
 
-    save_file(lines, args, if_created)
-    return
+    if not all_done(lock_dir, shards):
+        return
+    if merged(lock_dir):
+        if not extracted:
+            print('=> Worker {}: all shards in {} are extracted and merged already, nothing was done. '
+                  'Delete that folder to extract them again, e.g. with another checkpoint'.format(rank, lock_dir))
+        return
+    # the worker that finds all shards done first assembles the per-camera files
+    if not claim_merge(lock_dir, reclaim_before):
+        return
+    num_cams = 8 if args.dataset == 'duke' else 40
+    try:
+        for folder in get_folders(args):
+            shard_folders = OrderedDict((name, osp.join(folder, 'shards', name)) for name in shards)
+            num_rows = merge_shards(folder, shard_folders, num_cams, dtype=args.feat_dtype,
+                                    compression=None if args.compression == 'none' else args.compression,
+                                    num_header=get_num_header(args))
+            save_args(args, folder)
+            print('=> Merged {} shards, {} crops into {}'.format(len(shards), num_rows.sum(), folder))
+    except BaseException:
+        release_merge(lock_dir)
+        raise
+    mark_merged(lock_dir)
 
 
-def main(args):
+def pin_worker(args, rank):
+    # contiguous blocks of the allowed cores, so the workers do not compete for them
+    if args.workers > 1 and hasattr(os, 'sched_setaffinity'):
+        cores = np.array_split(sorted(os.sched_getaffinity(0)), args.workers)[rank]
+        if len(cores):
+            os.sched_setaffinity(0, cores.tolist())
+    device = args.device
+    if args.workers > 1 and device != 'cpu' and torch.cuda.is_available():
+        device = 'cuda:{}'.format(rank % torch.cuda.device_count())
+    return get_device(device, args.threads, args.num_workers)
+
+
+def main_worker(args, rank=0):
     tic = time.time()
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -164,56 +286,114 @@ def main(args):
         use_fname = False
 
     print(dataset_dir)
-    if args.dataset == 'duke':
+    if args.from_video:
+        # the crops are cut from the videos, there is no crop folder to list
+        dataset = None
+    elif args.dataset == 'duke':
         dataset = DukeMTMC(dataset_dir, type=type, iCams=tracking_icams, fps=fps, trainval=args.det_time == 'trainval')
     else:  # aic
         dataset = AI_City(dataset_dir, type=type, fps=fps, trainval=args.det_time == 'trainval', gt_type=args.gt_type)
 
     normalizer = T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    test_transformer = T.Compose([
-        T.Resize([args.height, args.width]),
-        T.RandomHorizontalFlip(),
-        T.Pad(10 * args.crop),
-        T.RandomCrop([args.height, args.width]),
-        T.ToTensor(),
-        normalizer,
-        T.RandomErasing(probability=args.re), ])
-    # Create model
-    if args.arch == 'zju':
-        model = models.create(args.arch, num_features=args.features, norm=args.norm,
-                              dropout=args.dropout, num_classes=0, last_stride=args.last_stride,
-                              output_feature=args.output_feature, backbone=args.backbone, BNneck=args.BNneck)
+    if args.flip_tta != 'none':
+        # deterministic, the flipped views are added to every batch by extract_cnn_feature
+        test_transformer = T.Compose([
+            T.Resize([args.height, args.width]),
+            T.ToTensor(),
+            normalizer, ])
     else:
-        model = models.create(args.arch, num_features=args.features, norm=args.norm,
-                              dropout=args.dropout, num_classes=0, last_stride=args.last_stride,
-                              output_feature=args.output_feature)
-    # Load from checkpoint
-    model, start_epoch, best_top1 = checkpoint_loader(model, args.resume, eval_only=True)
-    print("=> Start epoch {}".format(start_epoch))
-    model = nn.DataParallel(model).cuda()
-    model.eval()
+        test_transformer = T.Compose([
+            T.Resize([args.height, args.width]),
+            T.RandomHorizontalFlip(),
+            T.Pad(10 * args.crop),
+            T.RandomCrop([args.height, args.width]),
+            T.ToTensor(),
+            normalizer,
+            T.RandomErasing(probability=args.re), ])
+    device = pin_worker(args, rank)
+    print('=> Worker {} extracting on {} ({} cpu threads)'.format(rank, device, torch.get_num_threads()))
+
+    # Create models, one per checkpoint
+    model_s = []
+    for resume in args.resume:
+        if args.arch == 'zju':
+            model = models.create(args.arch, num_features=args.features, norm=args.norm,
+                                  dropout=args.dropout, num_classes=0, last_stride=args.last_stride,
+                                  output_feature=args.output_feature, backbone=args.backbone, BNneck=args.BNneck)
+        else:
+            model = models.create(args.arch, num_features=args.features, norm=args.norm,
+                                  dropout=args.dropout, num_classes=0, last_stride=args.last_stride,
+                                  output_feature=args.output_feature)
+        # Load from checkpoint
+        model, start_epoch, best_top1 = checkpoint_loader(model, resume, eval_only=True)
+        print("=> Start epoch {}".format(start_epoch))
+        model = model.to(device).eval()
+        if args.jit:
+            model = TracedModel(model, torch.zeros([2, 3, args.height, args.width], device=device))
+        elif device.type == 'cuda' and args.workers == 1:
+            model = nn.DataParallel(model)
+        model_s.append(model)
     toc = time.time() - tic
     print('*************** initialization takes time: {:^10.2f} *********************\n'.format(toc))
 
     tic = time.time()
     if args.type == 'reid_test':
-        args.reid_test = 'query'
-        data_loader = DataLoader(Preprocessor(dataset.query, root=dataset.query_path, transform=test_transformer),
-                                 batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False)
-        extract_features(model, data_loader, args, is_detection=False, use_fname=use_fname)
-        args.reid_test = 'gallery'
-        data_loader = DataLoader(Preprocessor(dataset.gallery, root=dataset.gallery_path, transform=test_transformer),
-                                 batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False)
-        extract_features(model, data_loader, args, is_detection=False, use_fname=use_fname)
+        for reid_test in ['query', 'gallery']:
+            args.reid_test = reid_test
+            folders = get_folders(args)
+            data_loader = get_loader(args, getattr(dataset, reid_test), getattr(dataset, reid_test + '_path'),
+                                     getattr(dataset, reid_test + '_info'), test_transformer, folders,
+                                     args.incremental)
+            extract_features(model_s, data_loader, args, folders, args.incremental,
+                             is_detection=False, use_fname=use_fname)
+    elif args.from_video:
+        # cv2, pandas and psutil are only needed to cut the crops from the videos
+        from reid.prepare.extract_bbox import get_cameras
+        from reid.feature_extraction.video import VideoCropLoader
+        bbox_type = 'det' if type == 'tracking_det' else 'labeled' if args.gt_type == 'labeled' else 'gt'
+        cameras = [camera for camera in get_cameras(bbox_type, args.det_time, args.det_type)
+                   if camera[0] in tracking_icams]
+        folders = get_folders(args)
+        done = trim_manifests([osp.join(folder, 'manifest.txt') for folder in folders]) if args.incremental else None
+        data_loader = VideoCropLoader(cameras, test_transformer, type=bbox_type, fps=fps,
+                                      batch_size=args.batch_size, skip=done)
+        print('=> {} crops from {} videos, {} already extracted'
+              .format(data_loader.num_rows.sum(), len(cameras), len(done or [])))
+        print('=> Crops are not JPEG re-encoded, the features do not match JPEG-based ones bit for bit')
+        extract_features(model_s, data_loader, args, folders, args.incremental,
+                         is_detection=type == 'tracking_det', use_fname=use_fname)
+    elif args.shard:
+        extract_shards(model_s, dataset, args, test_transformer, rank,
+                       is_detection=type == 'tracking_det', use_fname=use_fname)
     else:
-        data_loader = DataLoader(Preprocessor(dataset.train, root=dataset.train_path, transform=test_transformer),
-                                 batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False)
-        extract_features(model, data_loader, args, is_detection=type == 'tracking_det', use_fname=use_fname)
+        folders = get_folders(args)
+        data_loader = get_loader(args, dataset.train, dataset.train_path, dataset.train_info, test_transformer,
+                                 folders, args.incremental)
+        extract_features(model_s, data_loader, args, folders, args.incremental,
+                         is_detection=type == 'tracking_det', use_fname=use_fname)
     toc = time.time() - tic
     print('*************** compute features takes time: {:^10.2f} *********************\n'.format(toc))
     pass
 
 
+def main(args):
+    if args.workers == 1:
+        main_worker(args)
+        return
+    # spawn, since forked children cannot use cuda initialized in the parent
+    ctx = multiprocessing.get_context('spawn')
+    procs = [ctx.Process(target=main_worker, args=(args, rank)) for rank in range(args.workers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    failed = [rank for rank, proc in enumerate(procs) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError('workers {} failed. Rerun the same command: the unfinished shards of workers that died on '
+                           'this host are taken over, add --reclaim for those of other hosts once no other run is '
+                           'active'.format(failed))
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Softmax loss classification")
     # data
@@ -227,24 +407,74 @@ if __name__ == '__main__':
     parser.add_argument('--height', type=int, default=256, help="input height, default: 256 for resnet*")
     parser.add_argument('--width', type=int, default=128, help="input width, default: 128 for resnet*")
     # model
-    parser.add_argument('--resume', type=str, default='', metavar='PATH')
+    parser.add_argument('--resume', type=str, nargs='+', default=[], metavar='PATH',
+                        help="one or more checkpoints, all of them run on every decoded batch")
     parser.add_argument('--features', type=int, default=256)
     parser.add_argument('--dropout', type=float, default=0.5, help='0.5 for ide/pcb, 0 for triplet/zju')
     parser.add_argument('-s', '--last_stride', type=int, default=2, choices=[1, 2])
     parser.add_argument('--output_feature', type=str, default='fc', choices=['pool5', 'fc'])
     parser.add_argument('--norm', action='store_true', help="normalize feat, default: False")
     parser.add_argument('--BNneck', action='store_true', help="BN layer, default: False")
+    # inference backend
+    parser.add_argument('--device', type=str, default='auto', choices=['auto', 'cpu', 'cuda'])
+    parser.add_argument('--threads', type=int, default=0,
+                        help="intra-op cpu threads, default: cores not used by data workers")
+    parser.add_argument('--jit', action='store_true',
+                        help="run a traced graph of the model on a single device, default: False")
     # misc
     parser.add_argument('--seed', type=int, default=1)
-    working_dir = osp.dirname(osp.abspath(__file__))
     parser.add_argument('--logs-dir', type=str, metavar='PATH', default=osp.join(working_dir, 'logs'))
-    parser.add_argument('--l0_name', type=str, metavar='PATH')
+    parser.add_argument('--l0_name', type=str, nargs='*', default=[], metavar='PATH',
+                        help="output name of each checkpoint, leave empty to only save the ensemble")
+    parser.add_argument('--ensemble_name', type=str, default='', metavar='PATH',
+                        help="also save the normalized, concatenated features of all checkpoints")
     parser.add_argument('--det_time', type=str, metavar='PATH', default='val',
                         choices=['trainval_nano', 'trainval', 'train', 'val', 'test_all', 'test'])
     parser.add_argument('--det_type', type=str, default='ssd', choices=['ssd', 'yolo'])
     parser.add_argument('--gt_type', type=str, default='gt', choices=['gt', 'labeled'])
     parser.add_argument('--tracking_icams', type=int, default=0, help="specify if train on single iCam")
+    parser.add_argument('--feat_dtype', type=str, default='float32',
+                        choices=['float32', 'float64', 'float16', 'int8'],
+                        help="storage dtype of the h5 features, default: float32. float16 and int8 (per-row scale) "
+                             "store the header apart, read them with reid.feature_extraction.load_features")
+    parser.add_argument('--compression', type=str, default='none', choices=['none', 'gzip', 'lzf'])
+    parser.add_argument('--io_queue', type=int, default=64,
+                        help="batches buffered for the background h5 writer, 0 writes inline")
+    parser.add_argument('--incremental', action='store_true',
+                        help="resume an interrupted run or add new crops: only extract the crops "
+                             "missing from manifest.txt of the output folder, default: False")
+    parser.add_argument('--commit_freq', type=int, default=20,
+                        help="batches between two flushes of the features and the manifest, "
+                             "at most as many are extracted again after a crash, default: 20")
+    parser.add_argument('--from_video', action='store_true',
+                        help="aic detections/gt_all: cut the crops from vdo.avi and the bbox files "
+                             "instead of reading the crop JPEGs of reid/prepare/extract_bbox.py; the crops "
+                             "skip the lossy JPEG encoding, so the features differ slightly from JPEG-based ones")
+    # work queue
+    parser.add_argument('--shard', action='store_true',
+                        help="split the crops into shards claimed through lock files in <output>/shards, "
+                             "the same command can run on several hosts sharing the output folder")
+    parser.add_argument('--shard_size', type=int, default=0,
+                        help="crops (consecutive frames of one camera) per shard, 0 for one shard per camera")
+    parser.add_argument('--reclaim', action='store_true',
+                        help="take over the unfinished shards locked before this run, e.g. of crashed workers on "
+                             "other hosts; only when no other run is active")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="local worker processes, each pinned to its share of the cores, implies --shard")
     # data jittering
+    parser.add_argument('--flip_tta', type=str, default='none', choices=['none', 'avg', 'concat'],
+                        help="deterministic test transform, features of the image and its flipped copy "
+                             "from one forward pass, averaged or concatenated; ignores --re and --crop")
     parser.add_argument('--re', type=float, default=0, help="random erasing")
     parser.add_argument('--crop', action='store_true', help="resize then crop, default: False")
-    main(parser.parse_args())
+    args = parser.parse_args()
+    # shard locks older than this are stale for --reclaim
+    args.start_time = time.time()
+    if len(args.l0_name) not in (0, len(args.resume)) or not (args.l0_name or args.ensemble_name):
+        parser.error('give one --l0_name per --resume checkpoint and/or an --ensemble_name')
+    args.shard = args.shard or args.workers > 1
+    if args.shard and args.type == 'reid_test':
+        parser.error('--shard and --workers do not support --type reid_test')
+    if args.from_video and (args.dataset != 'aic' or args.type not in ('detections', 'gt_all') or args.shard):
+        parser.error('--from_video supports aic detections and gt_all, without --shard')
+    main(args)
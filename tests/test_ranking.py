@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+
+import numpy as np
+import pytest
+
+from reid.evaluation_metrics import cmc, mean_ap
+
+average_precision_score = pytest.importorskip('sklearn.metrics').average_precision_score
+
+
+def reference_cmc(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk=100,
+                  separate_camera_set=False, first_match_break=False):
+    # the per-query loop cmc was before vectorization; a stable sort ranks ties by gallery index
+    indices = np.argsort(distmat, axis=1, kind='stable')
+    matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
+    ret = np.zeros(topk)
+    num_valid_queries = 0
+    for i in range(len(distmat)):
+        valid = ((gallery_ids[indices[i]] != query_ids[i]) |
+                 (gallery_cams[indices[i]] != query_cams[i]))
+        if separate_camera_set:
+            valid &= (gallery_cams[indices[i]] != query_cams[i])
+        if not np.any(matches[i, valid]):
+            continue
+        index = np.nonzero(matches[i, valid])[0]
+        delta = 1. / len(index)
+        for j, k in enumerate(index):
+            if k - j >= topk:
+                break
+            if first_match_break:
+                ret[k - j] += 1
+                break
+            ret[k - j] += delta
+        num_valid_queries += 1
+    return ret.cumsum() / num_valid_queries
+
+
+def reference_mean_ap(distmat, query_ids, gallery_ids, query_cams, gallery_cams):
+    # the sklearn based mean_ap before vectorization
+    indices = np.argsort(distmat, axis=1)
+    matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
+    aps = []
+    for i in range(len(distmat)):
+        valid = ((gallery_ids[indices[i]] != query_ids[i]) |
+                 (gallery_cams[indices[i]] != query_cams[i]))
+        y_true = matches[i, valid]
+        y_score = -distmat[i][indices[i]][valid]
+        if not np.any(y_true):
+            continue
+        aps.append(average_precision_score(y_true, y_score))
+    return np.mean(aps)
+
+
+def random_problem(seed, ties):
+    rng = np.random.RandomState(seed)
+    m, n = rng.randint(5, 40), rng.randint(20, 120)
+    distmat = rng.rand(m, n)
+    if ties:
+        # few distinct distances, many ties across matches and non-matches
+        distmat = np.round(distmat * 4) / 4
+    num_ids, num_cams = rng.randint(3, 10), rng.randint(2, 4)
+    # small id and camera sets, so that many matches share the query camera
+    return (distmat, rng.randint(num_ids, size=m), rng.randint(num_ids, size=n),
+            rng.randint(num_cams, size=m), rng.randint(num_cams, size=n))
+
+
+@pytest.mark.parametrize('block_size', [None, 3])
+@pytest.mark.parametrize('ties', [False, True])
+def test_mean_ap_parity(block_size, ties):
+    for seed in range(10):
+        args = random_problem(seed, ties)
+        assert abs(mean_ap(*args, block_size=block_size) - reference_mean_ap(*args)) < 1e-12
+
+
+@pytest.mark.parametrize('block_size', [None, 3])
+@pytest.mark.parametrize('ties', [False, True])
+@pytest.mark.parametrize('separate_camera_set', [False, True])
+@pytest.mark.parametrize('first_match_break', [False, True])
+def test_cmc_parity(block_size, ties, separate_camera_set, first_match_break):
+    for seed in range(10):
+        args = random_problem(seed, ties)
+        for topk in (1, 5, 100):
+            expected = reference_cmc(*args, topk=topk, separate_camera_set=separate_camera_set,
+                                     first_match_break=first_match_break)
+            result = cmc(*args, topk=topk, separate_camera_set=separate_camera_set,
+                         first_match_break=first_match_break, block_size=block_size)
+            assert np.allclose(result, expected, rtol=0, atol=1e-12)
@@ -8,6 +8,7 @@ import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 from reid.feature_extraction import extract_cnn_feature
+from reid.evaluation_metrics import topk
 from reid.utils.my_utils import *
 from reid.utils.data.preprocessor import Preprocessor
 import time
@@ -122,16 +123,12 @@ def visualization(args):
         return output_features, labels, cameras
 
     # sort the images
-    def sort_img(qf, ql, qc, gf, gl, gc):
+    def sort_img(qf, ql, qc, gf, gl, gc, num=10):
         query = qf.view(-1,1)
         # print(query.shape)
         score = torch.mm(gf,query)
         score = score.squeeze(1).cpu()
         score = score.numpy()
-        # predict index
-        index = np.argsort(score)  #from small to large
-        index = index[::-1]
-        # index = index[0:2000]
         # good index
         query_index = np.argwhere(gl==ql)
         #same camera
@@ -142,6 +139,8 @@ def visualization(args):
         junk_index2 = np.intersect1d(query_index, camera_index)
         junk_index = np.append(junk_index2, junk_index1)
 
+        # predict index, from large to small, only as many as shown after removing the junk
+        index = topk(score[np.newaxis], num + len(junk_index), largest=True)[0]
         mask = np.in1d(index, junk_index, invert=True)
         index = index[mask]
         return index